@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from testing import (
+    INDICATOR_COLUMNS,
+    INSERT_STRATEGY_RESULT,
+    INSERT_TRADE,
+    OPTIONAL_INDICATOR_COLUMNS,
+    SAVE_POSITION,
+    STRATEGIES,
+    UPDATE_INDICATORS,
+    KlineFetcher,
+    WriteBatch,
+    calculate_indicators,
+    configure_logging,
+    create_tables,
+    get_high_water_marks,
+    insert_klines_to_db,
+    load_snapshot,
+    open_db,
+    process_klines,
+    set_fetcher,
+)
+
+HOUR_MS = 3_600_000
+
+def report(name, rows, seconds):
+    print(f'{name:<45} {rows:>10} rows {seconds:>9.3f} s {rows / seconds:>12,.0f} rows/s')
+
+def seed_database(path, market):
+    conn = open_db(path)
+    create_tables(conn)
+    start = time.perf_counter()
+    for symbol in market.symbols:
+        insert_klines_to_db(conn, symbol, market.klines(symbol, limit=market.candles), commit=False)
+    conn.commit()
+    report('seed raw_data (executemany, one transaction)', len(market.symbols) * market.candles,
+           time.perf_counter() - start)
+    conn.close()
+
+def indicator_updates(market, sample):
+    # Rows for the bot's own UPDATE_INDICATORS, spread over the seeded candles
+    rng = np.random.default_rng(market.seed)
+    values = rng.random((sample, len(INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS))).tolist()
+    symbols = len(market.symbols)
+    return [row + [market.symbols[i % symbols], '1h', market.start_ms + (i // symbols % market.candles) * HOUR_MS]
+            for i, row in enumerate(values)]
+
+def strategy_rows(sample):
+    positions, trades, results = [], [], []
+    for i in range(sample):
+        symbol = f'SYM{i}USDT'
+        timestamp = 1_500_000_000_000 + i * HOUR_MS
+        positions.append(('Benchmark', symbol, timestamp, 1.0, 10.0, 0.01, 'OPEN', None))
+        trades.append(('Benchmark', symbol, timestamp, timestamp, 1.0, 1.1, 10.0, 1.0, 10.0))
+        results.append(('Benchmark', symbol, timestamp, timestamp, 1.0, 1.1, 10.0, 1.0, 10.0))
+    return positions, trades, results
+
+def bench_before(path, market, sample):
+    # The old write path: sqlite defaults (rollback journal, synchronous=FULL), commit per row
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    cursor = conn.cursor()
+
+    updates = indicator_updates(market, sample)
+    start = time.perf_counter()
+    for row in updates:
+        cursor.execute(UPDATE_INDICATORS, row)
+        conn.commit()
+    report('before: indicator UPDATE, commit per row', len(updates), time.perf_counter() - start)
+
+    positions, trades, results = strategy_rows(sample // 3)
+    start = time.perf_counter()
+    for position, trade, result in zip(positions, trades, results):
+        cursor.execute(SAVE_POSITION, position)
+        conn.commit()
+        cursor.execute(INSERT_TRADE, trade)
+        conn.commit()
+        cursor.execute(INSERT_STRATEGY_RESULT, result)
+        conn.commit()
+    report('before: strategy inserts, commit per row', len(positions) * 3, time.perf_counter() - start)
+    conn.close()
+
+def bench_after(path, market, sample):
+    conn = open_db(path)
+
+    updates = indicator_updates(market, sample)
+    start = time.perf_counter()
+    with conn:
+        conn.executemany(UPDATE_INDICATORS, updates)
+    report('after: indicator UPDATE, executemany + WAL', len(updates), time.perf_counter() - start)
+
+    positions, trades, results = strategy_rows(sample // 3)
+    start = time.perf_counter()
+    batch = WriteBatch()
+    for position, trade, result in zip(positions, trades, results):
+        batch.add(SAVE_POSITION, position)
+        batch.add(INSERT_TRADE, trade)
+        batch.add(INSERT_STRATEGY_RESULT, result)
+    batch.flush(conn)
+    report('after: strategy inserts, WriteBatch + WAL', len(positions) * 3, time.perf_counter() - start)
+    conn.close()
+
+class SyntheticMarket:
+    # Deterministic random-walk candles for SYM0USDT, SYM1USDT, ...: candles + 1 per
+    # symbol, the last one held back for the incremental cycle. A symbol's series is
+    # regenerated on every request rather than kept, so memory does not grow with the
+    # number of symbols.
+    def __init__(self, symbols, candles, start_ms=1_500_000_000_000, seed=0):
+        self.symbols = [f'SYM{i}USDT' for i in range(symbols)]
+        self.candles = candles
+        self.start_ms = start_ms
+        self.seed = seed
+
+    def series(self, symbol):
+        rng = np.random.default_rng([self.seed, self.symbols.index(symbol)])
+        count = self.candles + 1
+        close = rng.uniform(0.1, 1000) * np.exp(np.cumsum(rng.normal(0, 0.01, count)))
+        open_ = np.r_[close[0], close[:-1]]
+        high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.003, count)))
+        low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.003, count)))
+        volume = rng.uniform(1, 1000, count)
+        trades = rng.integers(1, 5000, count)
+        return open_, high, low, close, volume, trades
+
+    def klines(self, symbol, start_ms=None, end_ms=None, limit=500):
+        # The /api/v3/klines rows for the range, prices and volumes as strings
+        lo = 0 if start_ms is None else max(0, -(-(start_ms - self.start_ms) // HOUR_MS))
+        hi = self.candles + 1 if end_ms is None else min(self.candles + 1, (end_ms - self.start_ms) // HOUR_MS + 1)
+        hi = min(hi, lo + limit)
+        if hi <= lo:
+            return []
+        rows = []
+        for i, (o, h, l, c, v, n) in enumerate(zip(*[column[lo:hi].tolist() for column in self.series(symbol)]), lo):
+            open_time = self.start_ms + i * HOUR_MS
+            rows.append([
+                open_time, f'{o:.8f}', f'{h:.8f}', f'{l:.8f}', f'{c:.8f}', f'{v:.8f}', open_time + HOUR_MS - 1,
+                f'{v * c:.8f}', n, f'{v / 2:.8f}', f'{v * c / 2:.8f}', '0',
+            ])
+        return rows
+
+class StubTransport:
+    # Stands in for RequestsTransport: answers /api/v3/klines from a SyntheticMarket
+    # with a JSON body that is decoded the way response.json() would
+    def __init__(self, market):
+        self.market = market
+
+    def get(self, url, params=None, timeout=10):
+        params = params or {}
+        if not url.endswith('/api/v3/klines'):
+            return 404, {}, None
+        body = json.dumps(self.market.klines(params['symbol'], params.get('startTime'), params.get('endTime'),
+                                             params.get('limit', 500)))
+        return 200, {}, json.loads(body)
+
+class StageTimer:
+    # Wall time of every call per stage, and the rows each call handled
+    def __init__(self):
+        self.samples = {}
+
+    def run(self, stage, rows, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault(stage, []).append((time.perf_counter() - start, rows(result) if callable(rows) else rows))
+        return result
+
+def run_stages(conn, market, timer, symbols):
+    # Every stage for each symbol in turn, so only one symbol's klines are in memory:
+    # a cold backfill through the fetcher, its insert, the indicators, the snapshot
+    # and each registered strategy, then an incremental cycle with one new candle
+    fetcher = KlineFetcher(transport=StubTransport(market), max_retries=0)
+    set_fetcher(fetcher)
+    end_ms = market.start_ms + (market.candles - 1) * HOUR_MS
+    for symbol in symbols:
+        klines = timer.run('fetch', len, fetcher.fetch_range, symbol, '1h', market.start_ms, end_ms)
+        timer.run('ingest', len(klines), insert_klines_to_db, conn, symbol, klines)
+        timer.run('indicators', len(klines), calculate_indicators, conn, symbol)
+        snapshot = timer.run('snapshot', len, load_snapshot, conn, symbol)
+        for strategy_name, strategy_func in STRATEGIES:
+            timer.run(f'strategy: {strategy_name}', len(snapshot), strategy_func, conn, symbol, strategy_name, snapshot)
+        del klines, snapshot
+    marks = get_high_water_marks(conn)
+    for symbol in symbols:
+        klines = fetcher.fetch_klines(symbol, '1h', limit=2, startTime=marks[symbol])
+        timer.run('cycle', len(klines), process_klines, conn, symbol, klines)
+
+def stage_memory(path, market, symbols):
+    # Peak traced allocation per stage, from a separate run over a few symbols:
+    # tracemalloc slows everything down too much to leave on while timing
+    conn = open_db(path)
+    create_tables(conn)
+    peaks = {}
+
+    class PeakTimer(StageTimer):
+        def run(self, stage, rows, func, *args):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            result = func(*args)
+            peaks[stage] = max(peaks.get(stage, 0), tracemalloc.get_traced_memory()[1] - before)
+            return result
+
+    tracemalloc.start()
+    try:
+        run_stages(conn, market, PeakTimer(), symbols)
+    finally:
+        tracemalloc.stop()
+        conn.close()
+    return peaks
+
+def summarize(samples, peaks):
+    stages = {}
+    for stage, calls in samples.items():
+        seconds = np.array([call[0] for call in calls])
+        rows = sum(call[1] for call in calls)
+        p50, p95, p99 = np.percentile(seconds * 1000, [50, 95, 99]).tolist()
+        stages[stage] = {
+            'calls': len(calls), 'rows': rows, 'seconds': float(seconds.sum()),
+            'rows_per_second': rows / seconds.sum() if seconds.sum() else 0.0,
+            'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'peak_mb': peaks.get(stage, 0) / 2**20,
+        }
+    return stages
+
+def print_stages(stages):
+    print(f'{"stage":<45} {"calls":>6} {"rows":>10} {"rows/s":>12} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"peak MB":>8}')
+    for stage, s in stages.items():
+        print(f'{stage:<45} {s["calls"]:>6} {s["rows"]:>10} {s["rows_per_second"]:>12,.0f} {s["p50_ms"]:>9.2f} '
+              f'{s["p95_ms"]:>9.2f} {s["p99_ms"]:>9.2f} {s["peak_mb"]:>8.1f}')
+
+def compare(stages, baseline, tolerance):
+    # Throughput and p95 latency against a saved run; returns the stages that got
+    # slower by more than tolerance on either
+    regressions = []
+    print(f'\n{"stage":<45} {"rows/s":>10} {"p95":>10}  vs baseline')
+    for stage, s in stages.items():
+        old = baseline['stages'].get(stage)
+        if old is None:
+            print(f'{stage:<45} {"new":>10}')
+            continue
+        throughput = s['rows_per_second'] / old['rows_per_second'] - 1 if old['rows_per_second'] else 0.0
+        latency = s['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0.0
+        slower = throughput < -tolerance or latency > tolerance
+        if slower:
+            regressions.append(stage)
+        print(f'{stage:<45} {throughput:>+10.1%} {latency:>+10.1%}  {"REGRESSION" if slower else ""}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the ingestion, indicator and strategy stages on '
+                                                 'synthetic klines, served by a stub transport into a temporary database')
+    parser.add_argument('--symbols', type=int, default=200)
+    parser.add_argument('--candles', type=int, default=10_000, help='candles per symbol')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory-symbols', type=int, default=3,
+                        help='symbols in the separate tracemalloc run that measures peak memory; 0 skips it')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results to FILE as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with results saved by --save-baseline; exits 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='slowdown in throughput or p95 latency that counts as a regression (default 0.10)')
+    parser.add_argument('--write-path', action='store_true',
+                        help='run the old commit-per-row vs batched WAL write comparison instead')
+    parser.add_argument('--sample', type=int, default=3000, help='rows written by each write-path benchmark')
+    parser.add_argument('--db', help='database file (default: a temporary file)')
+    args = parser.parse_args()
+    # Every signal is logged at INFO; only problems belong in the report
+    configure_logging('WARNING')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'benchmark.db')
+        market = SyntheticMarket(args.symbols, args.candles, seed=args.seed)
+        if args.write_path:
+            seed_database(path, market)
+            bench_before(path, market, args.sample)
+            bench_after(path, market, args.sample)
+            return
+
+        conn = open_db(path)
+        create_tables(conn)
+        timer = StageTimer()
+        started = time.perf_counter()
+        try:
+            run_stages(conn, market, timer, market.symbols)
+            peaks = {}
+            if args.memory_symbols:
+                peaks = stage_memory(os.path.join(tmp, 'memory.db'), market, market.symbols[:args.memory_symbols])
+        finally:
+            conn.close()
+        print(f'{args.symbols} symbols x {args.candles} candles in {time.perf_counter() - started:.1f} s\n')
+        stages = summarize(timer.samples, peaks)
+        print_stages(stages)
+
+    results = {'config': {'symbols': args.symbols, 'candles': args.candles, 'seed': args.seed}, 'stages': stages}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != results['config']:
+            print(f"\nBaseline was run with {baseline['config']}, this run with {results['config']}")
+        if compare(stages, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
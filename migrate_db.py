@@ -0,0 +1,127 @@
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+
+from testing import CLOSE_UNHELD_POSITIONS, create_tables, open_db
+
+# One-shot conversion of a database written before timestamps were stored as UTC
+# epoch milliseconds. The old values are naive local datetimes, so run this on a
+# machine in the same timezone as the one that wrote them.
+
+# Tables to copy in this order, with their timestamp columns. strategy_results comes
+# before the tables that take their missing strategy from it.
+LEGACY_TABLES = {
+    'raw_data': ['timestamp'],
+    'strategy_results': ['entry_timestamp', 'exit_timestamp'],
+    'positions': ['entry_timestamp'],
+    'trades': ['entry_timestamp', 'exit_timestamp'],
+    'indicator_state': ['last_timestamp'],
+    'strategy_state': ['entry_timestamp', 'last_timestamp'],
+}
+
+# The first versions wrote positions and trades without a strategy column. Their
+# strategy is the one of the strategy_results row with the same values.
+STRATEGY_MATCH_COLUMNS = {
+    'positions': ['symbol', 'entry_timestamp', 'entry_price', 'quantity'],
+    'trades': ['symbol', 'entry_timestamp', 'exit_timestamp', 'entry_price', 'exit_price', 'quantity'],
+}
+
+def legacy_to_ms(timestamp):
+    if timestamp is None:
+        return None
+    return int(datetime.fromisoformat(str(timestamp)).timestamp() * 1000)
+
+def needs_migration(conn):
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(raw_data)')}
+    return bool(columns) and 'interval' not in columns
+
+def legacy_select(table, columns):
+    # SELECT over legacy_{table} yielding the new table's columns, with timestamps
+    # converted and, where the table had no strategy column, the strategy recovered
+    converted = {column: f'legacy_to_ms(l.{column})' if column in LEGACY_TABLES[table] else f'l.{column}'
+                 for column in columns}
+    if table not in STRATEGY_MATCH_COLUMNS or 'strategy' in columns:
+        return columns, f"SELECT {', '.join(converted[column] for column in columns)} FROM legacy_{table} l ORDER BY l.rowid"
+    # Several strategies can record identical trades, and a replayed cycle writes
+    # every one of them again. The n-th copy of a row goes to the (n mod k)-th of
+    # the k strategies with matching results, in the order they first wrote one.
+    match = STRATEGY_MATCH_COLUMNS[table]
+    values = ', '.join(match)
+    select = ', '.join(['m.strategy'] + [converted[column] for column in columns])
+    on = ' AND '.join(f'm.{column} = {converted[column]}' for column in match)
+    return ['strategy'] + columns, f'''
+        WITH matches AS (
+            SELECT {values}, strategy,
+                   ROW_NUMBER() OVER (PARTITION BY {values} ORDER BY MIN(id)) - 1 AS n,
+                   COUNT(*) OVER (PARTITION BY {values}) AS k
+            FROM strategy_results
+            GROUP BY {values}, strategy
+        ), legacy AS (
+            SELECT *, rowid AS legacy_rowid, ROW_NUMBER() OVER (PARTITION BY {values} ORDER BY rowid) - 1 AS copy
+            FROM legacy_{table}
+        )
+        SELECT {select}
+        FROM legacy l
+        LEFT JOIN matches m ON {on} AND m.n = l.copy % m.k
+        ORDER BY l.legacy_rowid
+    '''
+
+def migrate(path, backup=True):
+    conn = open_db(path)
+    if not needs_migration(conn):
+        print(f"{path} is already up to date")
+        conn.close()
+        return
+    if backup:
+        with sqlite3.connect(path + '.bak') as copy:
+            conn.backup(copy)
+        print(f"Backup written to {path}.bak")
+    size_before = os.path.getsize(path)
+
+    present = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    tables = [name for name in LEGACY_TABLES if name in present]
+    with conn:
+        for table in tables:
+            conn.execute(f'ALTER TABLE {table} RENAME TO legacy_{table}')
+            # Renamed tables keep their index names, which create_tables needs
+            conn.execute(f'DROP INDEX IF EXISTS {table}_entry')
+    create_tables(conn)
+
+    conn.create_function('legacy_to_ms', 1, legacy_to_ms, deterministic=True)
+    with conn:
+        for table in tables:
+            # Columns that older versions did not have yet are left at their defaults.
+            # OR IGNORE drops duplicate trades through the (strategy, symbol,
+            # entry_timestamp) indexes, which only applies to rows with a strategy.
+            columns, select = legacy_select(table, [row[1] for row in conn.execute(f'PRAGMA table_info(legacy_{table})')])
+            conn.execute(f'INSERT OR IGNORE INTO {table} ({", ".join(columns)}) {select}')
+            if table in STRATEGY_MATCH_COLUMNS:
+                # Unique indexes treat NULLs as distinct, so rows whose strategy could not
+                # be recovered are deduplicated here
+                every = [row[1] for row in conn.execute(f'PRAGMA table_info({table})') if row[1] != 'id']
+                conn.execute(f'''
+                    DELETE FROM {table}
+                    WHERE strategy IS NULL AND id NOT IN (
+                        SELECT MIN(id) FROM {table} WHERE strategy IS NULL GROUP BY {', '.join(every)}
+                    )
+                ''')
+            print(f"{table}: {conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]} rows")
+            conn.execute(f'DROP TABLE legacy_{table}')
+        # create_tables made positions with its status column before the rows arrived,
+        # so it had nothing to close
+        conn.execute(CLOSE_UNHELD_POSITIONS)
+    conn.execute('VACUUM')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    print(f"{path}: {size_before / 1e6:.1f} MB -> {os.path.getsize(path) / 1e6:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert crypto_trading.db to integer epoch-ms timestamps')
+    parser.add_argument('--db', default='crypto_trading.db')
+    parser.add_argument('--no-backup', action='store_true', help='do not write a .bak copy first')
+    args = parser.parse_args()
+    migrate(args.db, backup=not args.no_backup)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import itertools
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from testing import FEE_RATE, POSITION_SIZE, SLIPPAGE, STARTING_BALANCE, create_tables, get_indicator_cache, open_db, run_backtest
+
+class IndicatorArrays:
+    # One symbol's indicators through the worker's IndicatorCache. Combinations that share
+    # a window, and the other strategies this worker evaluates on the symbol, reuse them.
+    def __init__(self, symbol, candles, interval='1h'):
+        self.cache = get_indicator_cache()
+        self.cache.update(symbol, interval, candles)
+        self.symbol = symbol
+        self.interval = interval
+        self.close = candles['close'].to_numpy()
+
+    def get(self, name, *params):
+        return self.cache.get(self.symbol, self.interval, name, *params)
+
+# Signal functions: parameterized versions of the live strategies, returning buy/sell masks
+def ema_crossover_signals(ind, fast, slow):
+    short, long = ind.get('ema', fast), ind.get('ema', slow)
+    return short > long, short < long
+
+def rsi_signals(ind, window, low, high):
+    values = ind.get('rsi', window)
+    return values < low, values > high
+
+def ma_crossover_signals(ind, short, long):
+    short, long = ind.get('sma', short), ind.get('sma', long)
+    return short > long, short < long
+
+def stochastic_signals(ind, window, low, high):
+    k = ind.get('stoch_k', window)
+    return k < low, k > high
+
+def simple_signals(ind, fast, slow, rsi_window, rsi_low, rsi_high, bb_window, bb_dev, adx_window, adx_min):
+    short, long = ind.get('ema', fast), ind.get('ema', slow)
+    values = ind.get('rsi', rsi_window)
+    macd = ind.get('macd_diff', fast, slow, 9)
+    bb_high, bb_low = ind.get('bb_high', bb_window, bb_dev), ind.get('bb_low', bb_window, bb_dev)
+    trend = ind.get('adx', adx_window) > adx_min
+    # The live strategy also waits for sma_50 and sma_200
+    ready = ~np.isnan(ind.get('sma', 200))
+    buy = (short > long) & (values < rsi_low) & (macd > 0) & (ind.close > bb_low) & trend & ready
+    sell = (short < long) & (values > rsi_high) & (macd < 0) & (ind.close < bb_high) & trend & ready
+    return buy, sell
+
+# What can be swept per strategy: the signal function, the values to try for each of
+# its parameters (the live strategy's values are in DEFAULTS) and a validity check
+SWEEPS = {
+    'EMA Crossover Strategy': {
+        'signals': ema_crossover_signals,
+        'grid': {'fast': range(3, 31), 'slow': range(10, 201, 5)},
+        'valid': lambda p: p['fast'] < p['slow'],
+    },
+    'RSI Overbought/Oversold Strategy': {
+        'signals': rsi_signals,
+        'grid': {'window': range(5, 31), 'low': range(10, 42, 2), 'high': range(60, 92, 2)},
+    },
+    'Moving Average Crossover Strategy': {
+        'signals': ma_crossover_signals,
+        'grid': {'short': range(5, 101, 5), 'long': range(50, 301, 10)},
+        'valid': lambda p: p['short'] < p['long'],
+    },
+    'Stochastic Oscillator Strategy': {
+        'signals': stochastic_signals,
+        'grid': {'window': range(5, 31), 'low': range(5, 45, 5), 'high': range(60, 100, 5)},
+    },
+    'Simple Strategy': {
+        'signals': simple_signals,
+        'grid': {'fast': [8, 12, 16], 'slow': [21, 26, 35], 'rsi_window': [10, 14, 20], 'rsi_low': [25, 30, 35],
+                 'rsi_high': [65, 70, 75], 'bb_window': [20], 'bb_dev': [2], 'adx_window': [14],
+                 'adx_min': [15, 20, 25, 30]},
+        'valid': lambda p: p['fast'] < p['slow'],
+    },
+}
+
+DEFAULTS = {
+    'EMA Crossover Strategy': {'fast': 12, 'slow': 26},
+    'RSI Overbought/Oversold Strategy': {'window': 14, 'low': 30, 'high': 70},
+    'Moving Average Crossover Strategy': {'short': 50, 'long': 200},
+    'Stochastic Oscillator Strategy': {'window': 14, 'low': 20, 'high': 80},
+    'Simple Strategy': {'fast': 12, 'slow': 26, 'rsi_window': 14, 'rsi_low': 30, 'rsi_high': 70,
+                        'bb_window': 20, 'bb_dev': 2, 'adx_window': 14, 'adx_min': 25},
+}
+
+def parameter_sets(strategy_name, samples=None, seed=0):
+    # The whole grid, or `samples` distinct combinations drawn from it; the live
+    # parameters are always included so every run has them as a baseline
+    sweep = SWEEPS[strategy_name]
+    names = list(sweep['grid'])
+    valid = sweep.get('valid', lambda p: True)
+    combos = [dict(zip(names, values)) for values in itertools.product(*sweep['grid'].values())]
+    combos = [params for params in combos if valid(params)]
+    if samples is not None and samples < len(combos):
+        combos = random.Random(seed).sample(combos, samples)
+    if DEFAULTS[strategy_name] not in combos:
+        combos.insert(0, DEFAULTS[strategy_name])
+    return combos
+
+def walk_forward_bounds(start_ms, end_ms, folds):
+    # Rolling walk-forward: the history is cut into folds + 1 equal time spans, and
+    # fold i trains on span i and tests on span i + 1
+    edges = np.linspace(start_ms, end_ms + 1, folds + 2).astype(np.int64).tolist()
+    return [((edges[i], edges[i + 1]), (edges[i + 1], edges[i + 2])) for i in range(folds)]
+
+def evaluate_symbol(strategy_name, symbol, candles, combos, bounds, position_size=POSITION_SIZE,
+                    fee_rate=FEE_RATE, slippage=SLIPPAGE):
+    # Worker task: every combination over one symbol's train and test spans. Returns an
+    # array of shape (combos, folds, 2, 3) holding P&L, trades and winning trades, and
+    # the cache hits and misses it caused.
+    cache = get_indicator_cache()
+    before = cache.stats()
+    ind = IndicatorArrays(symbol, candles)
+    signals = SWEEPS[strategy_name]['signals']
+    timestamps = candles['timestamp'].to_numpy()
+    spans = [[np.searchsorted(timestamps, span).tolist() for span in fold] for fold in bounds]
+    results = np.zeros((len(combos), len(bounds), 2, 3))
+    for c, params in enumerate(combos):
+        buy, sell = signals(ind, **params)
+        for f, fold in enumerate(spans):
+            for s, (lo, hi) in enumerate(fold):
+                if hi - lo < 2:
+                    continue
+                result = run_backtest(buy[lo:hi], sell[lo:hi], ind.close[lo:hi], position_size, STARTING_BALANCE,
+                                      fee_rate=fee_rate, slippage=slippage)
+                results[c, f, s] = result.profit_loss.sum(), len(result.profit_loss), (result.profit_loss > 0).sum()
+    after = cache.stats()
+    return results, {name: after[name] - before[name] for name in ('hits', 'tail_recomputes', 'misses', 'evictions')}
+
+def load_candles(conn, symbol, interval='1h'):
+    return pd.read_sql_query('''
+        SELECT timestamp, open, high, low, close, volume
+        FROM raw_data
+        WHERE symbol = ? AND interval = ?
+        ORDER BY timestamp ASC
+    ''', conn, params=(symbol, interval))
+
+SAVE_OPTIMIZATION_RESULT = '''
+    INSERT INTO optimization_results (
+        run_id, strategy, params, fold, train_start, train_end, test_start, test_end,
+        train_profit, train_trades, train_win_rate, test_profit, test_trades, test_win_rate, rank
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def optimize(conn, strategy_names, symbols=None, folds=4, samples=None, seed=0, workers=None,
+             position_size=POSITION_SIZE, min_candles=500, interval='1h', fee_rate=FEE_RATE, slippage=SLIPPAGE):
+    # Sweep every strategy over every symbol with enough history, sum the outcomes
+    # across symbols and store one ranked row per (combination, fold)
+    if symbols is None:
+        symbols = [symbol for (symbol,) in conn.execute('''
+            SELECT symbol FROM raw_data WHERE interval = ? GROUP BY symbol HAVING COUNT(*) >= ?
+        ''', (interval, min_candles))]
+    start_ms, end_ms = conn.execute(f'''
+        SELECT MIN(timestamp), MAX(timestamp) FROM raw_data
+        WHERE interval = ? AND symbol IN ({', '.join('?' * len(symbols))})
+    ''', [interval] + symbols).fetchone()
+    if start_ms is None:
+        print("No candles to optimize on")
+        return None
+    bounds = walk_forward_bounds(start_ms, end_ms, folds)
+    combos = {name: parameter_sets(name, samples, seed) for name in strategy_names}
+    totals = {name: np.zeros((len(combos[name]), folds, 2, 3)) for name in strategy_names}
+    run_id = int(time.time() * 1000)
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # One task per (symbol, strategy), so a worker computes each indicator once for all combinations
+        futures = {}
+        for symbol in symbols:
+            candles = load_candles(conn, symbol, interval)
+            for name in strategy_names:
+                future = pool.submit(evaluate_symbol, name, symbol, candles, combos[name], bounds, position_size,
+                                     fee_rate, slippage)
+                futures[future] = name
+        cache_stats = {}
+        for done, future in enumerate(as_completed(futures), start=1):
+            results, stats = future.result()
+            totals[futures[future]] += results
+            for stat, count in stats.items():
+                cache_stats[stat] = cache_stats.get(stat, 0) + count
+            if done % 50 == 0 or done == len(futures):
+                print(f"Evaluated {done}/{len(futures)} symbol/strategy tasks")
+    evaluations = sum(len(combos[name]) for name in strategy_names) * len(symbols) * folds
+    print(f"{evaluations} combination/symbol/fold evaluations in {time.perf_counter() - started:.1f} s")
+    print(f"Indicator cache: {cache_stats}")
+
+    rows = []
+    for name in strategy_names:
+        total = totals[name]
+        for f, ((train_start, train_end), (test_start, test_end)) in enumerate(bounds):
+            order = np.argsort(-total[:, f, 0, 0], kind='stable')
+            for rank, c in enumerate(order.tolist(), start=1):
+                (train_pl, train_trades, train_wins), (test_pl, test_trades, test_wins) = total[c, f]
+                rows.append((
+                    run_id, name, json.dumps(combos[name][c], sort_keys=True), f,
+                    train_start, train_end, test_start, test_end,
+                    train_pl, int(train_trades), train_wins / train_trades if train_trades else None,
+                    test_pl, int(test_trades), test_wins / test_trades if test_trades else None, rank,
+                ))
+    with conn:
+        conn.executemany(SAVE_OPTIMIZATION_RESULT, rows)
+    return run_id
+
+def print_summary(conn, run_id):
+    # Walk-forward view: the best combination on each training span, how it did on the
+    # following test span, and the live parameters on the same test spans
+    for (name,) in conn.execute('SELECT DISTINCT strategy FROM optimization_results WHERE run_id = ?', (run_id,)).fetchall():
+        print(f"\n{name}")
+        chosen, baseline = 0.0, 0.0
+        default = json.dumps(DEFAULTS[name], sort_keys=True)
+        for fold, params, train_pl, test_pl in conn.execute('''
+            SELECT fold, params, train_profit, test_profit FROM optimization_results
+            WHERE run_id = ? AND strategy = ? AND rank = 1 ORDER BY fold
+        ''', (run_id, name)).fetchall():
+            live = conn.execute('''
+                SELECT test_profit FROM optimization_results
+                WHERE run_id = ? AND strategy = ? AND fold = ? AND params = ?
+            ''', (run_id, name, fold, default)).fetchone()[0]
+            chosen += test_pl
+            baseline += live
+            print(f"  fold {fold}: {params} train P&L {train_pl:.2f}, test P&L {test_pl:.2f} (live parameters {live:.2f})")
+        print(f"  walk-forward test P&L {chosen:.2f} vs {baseline:.2f} with the live parameters")
+
+def main():
+    parser = argparse.ArgumentParser(description='Walk-forward parameter sweep over the stored raw_data history')
+    parser.add_argument('--db', default='crypto_trading.db')
+    parser.add_argument('--strategy', action='append', choices=list(SWEEPS),
+                        help='strategy to sweep (repeatable; default: all)')
+    parser.add_argument('--symbols', nargs='+', help='symbols to use (default: all with --min-candles candles)')
+    parser.add_argument('--min-candles', type=int, default=500)
+    parser.add_argument('--folds', type=int, default=4)
+    parser.add_argument('--samples', type=int, help='random combinations per strategy instead of the full grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--position-size', type=float, default=POSITION_SIZE)
+    parser.add_argument('--fee-rate', type=float, default=FEE_RATE, help='fee per side as a fraction of the notional')
+    parser.add_argument('--slippage', type=float, default=SLIPPAGE, help='fill price offset as a fraction of the close')
+    args = parser.parse_args()
+
+    conn = open_db(args.db)
+    create_tables(conn)
+    run_id = optimize(conn, args.strategy or list(SWEEPS), args.symbols, args.folds, args.samples, args.seed,
+                      args.workers, args.position_size, args.min_candles, fee_rate=args.fee_rate,
+                      slippage=args.slippage)
+    if run_id is not None:
+        print_summary(conn, run_id)
+        print(f"\nAll ranked results are in optimization_results with run_id {run_id}")
+    conn.close()
+
+if __name__ == '__main__':
+    main()
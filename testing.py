@@ -1,47 +1,661 @@
+import argparse
+import bisect
+import cProfile
+import functools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import shutil
 import sqlite3
+import tempfile
 import requests
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timezone
 from ta.trend import EMAIndicator, MACD
-from ta.momentum import RSIIndicator
+from ta.momentum import RSIIndicator, StochasticOscillator
 from ta.volatility import BollingerBands
 from ta.trend import ADXIndicator
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import re
+import threading
 import time
 
-# Fetch USDT pairs from Binance without API keys
+logger = logging.getLogger('crypto_bot')
+
+class JsonLogFormatter(logging.Formatter):
+    # One JSON object per line; fields passed with extra= become keys of their own
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RESERVED)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# What configure_logging was last called with, passed on to the pipeline's workers
+_log_settings = None
+
+def configure_logging(level='INFO', json_lines=False):
+    global _log_settings
+    _log_settings = (level, json_lines)
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonLogFormatter() if json_lines else
+                         logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+# Upper bounds in seconds of the buckets every histogram counts into
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS_PREFIX = 'crypto_bot_'
+
+class Metrics:
+    # Counters, gauges and latency histograms keyed by name and labels, rendered in
+    # the Prometheus text format. Updated from the fetch threads, so every change
+    # takes the lock. Pipeline workers drain() theirs into each result, and the
+    # main process merge()s it.
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return self.buckets, self.counters, self.gauges, self.histograms
+
+    def __setstate__(self, state):
+        self.buckets, self.counters, self.gauges, self.histograms = state
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        # Label values are rendered as text anyway; as text they also sort together,
+        # e.g. an HTTP status of 200 next to 'error'
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self):
+        # Everything recorded so far, as a new Metrics; this one starts over
+        with self.lock:
+            drained = Metrics(self.buckets)
+            drained.counters, drained.gauges, drained.histograms = self.counters, self.gauges, self.histograms
+            self.counters, self.gauges, self.histograms = {}, {}, {}
+        return drained
+
+    def merge(self, other):
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(other.gauges)
+            for key, (counts, total, count) in other.histograms.items():
+                histogram = self.histograms.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self):
+        def labels(pairs):
+            escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs]
+            return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}' if pairs else ''
+
+        with self.lock:
+            lines = []
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f'# TYPE {METRICS_PREFIX}{name} {kind}')
+                    for (key, pairs), value in sorted(series.items()):
+                        if key == name:
+                            lines.append(f'{METRICS_PREFIX}{name}{labels(pairs)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {METRICS_PREFIX}{name} histogram')
+                for (key, pairs), (counts, total, count) in sorted(self.histograms.items()):
+                    if key != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f'{METRICS_PREFIX}{name}_bucket{labels(pairs + (("le", bound),))} {cumulative}')
+                    lines.append(f'{METRICS_PREFIX}{name}_sum{labels(pairs)} {total}')
+                    lines.append(f'{METRICS_PREFIX}{name}_count{labels(pairs)} {count}')
+        return '\n'.join(lines) + '\n'
+
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+def set_metrics(metrics):
+    global _metrics
+    _metrics = metrics
+
+def timed(stage):
+    # Record every call of the decorated function in the stage_seconds histogram
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().timer('stage_seconds', stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start_metrics_server(port, host='127.0.0.1'):
+    # get_metrics() at http://host:port/metrics, served from a daemon thread
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = get_metrics().render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug('Metrics request: ' + format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class CycleProfiler:
+    # Optional cProfile run around every polling cycle, saved as directory/cycle-<n>.prof
+    # for pstats or snakeviz. Pipeline workers are separate processes and are not profiled.
+    def __init__(self, directory):
+        self.directory = directory
+        self.cycles = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def cycle(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.cycles += 1
+            path = os.path.join(self.directory, f'cycle-{self.cycles:05d}.prof')
+            profile.dump_stats(path)
+            logger.debug('Cycle profile written to %s', path)
+
+BINANCE_API = 'https://api.binance.com'
+
+# Binance allows 6000 request weight per IP per minute; leave headroom for other clients
+REQUEST_WEIGHT_LIMIT = 5000
+
+INTERVAL_MS = {
+    '1m': 60_000,
+    '3m': 180_000,
+    '5m': 300_000,
+    '15m': 900_000,
+    '30m': 1_800_000,
+    '1h': 3_600_000,
+    '2h': 7_200_000,
+    '4h': 14_400_000,
+    '6h': 21_600_000,
+    '12h': 43_200_000,
+    '1d': 86_400_000,
+}
+
+# Largest page the klines endpoint returns
+KLINES_PAGE_LIMIT = 1000
+
+# History loaded for a symbol seen for the first time
+BACKFILL_CANDLES = 500
+
+class RequestsTransport:
+    # Keep-alive HTTP transport; anything with the same get() signature can replace it
+    def __init__(self, pool_size=32):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, params=None, timeout=10):
+        response = self.session.get(url, params=params, timeout=timeout)
+        payload = response.json() if response.status_code == 200 else None
+        return response.status_code, response.headers, payload
+
+class WeightBudget:
+    # Request weight spent in the current minute, counted the way Binance counts it
+    def __init__(self, limit=REQUEST_WEIGHT_LIMIT, window=60):
+        self.limit = limit
+        self.window = window
+        self.used = 0
+        self.window_start = 0
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _roll(self, now):
+        window_start = int(now // self.window) * self.window
+        if window_start != self.window_start:
+            self.window_start = window_start
+            self.used = 0
+
+    def acquire(self, weight):
+        while True:
+            with self.lock:
+                now = time.time()
+                self._roll(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.used + weight > self.limit:
+                    wait = self.window_start + self.window - now
+                else:
+                    self.used += weight
+                    return
+            time.sleep(max(wait, 0.01))
+
+    def sync(self, used):
+        # The exchange's X-MBX-USED-WEIGHT-1M header also counts other clients on this IP
+        with self.lock:
+            self._roll(time.time())
+            self.used = max(self.used, used)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+def kline_weight(limit):
+    if limit < 100:
+        return 1
+    if limit < 500:
+        return 2
+    if limit <= 1000:
+        return 5
+    return 10
+
+class KlineFetcher:
+    def __init__(self, transport=None, base_url=BINANCE_API, max_workers=16,
+                 weight_limit=REQUEST_WEIGHT_LIMIT, max_retries=5, backoff=0.5, timeout=10):
+        self.transport = transport or RequestsTransport(pool_size=max_workers)
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.budget = WeightBudget(weight_limit)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def _delay(self, attempt):
+        return self.backoff * (2 ** attempt) * (1 + random.random())
+
+    def request(self, path, params=None, weight=1):
+        # Retries 418/429 (honouring Retry-After), 5xx and connection errors with backoff
+        metrics = get_metrics()
+        status = None
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(weight)
+            try:
+                with metrics.timer('http_request_seconds', endpoint=path):
+                    status, headers, payload = self.transport.get(self.base_url + path, params, self.timeout)
+            except Exception as e:
+                logger.warning('Error requesting %s: %s', path, e, extra={'endpoint': path})
+                metrics.inc('http_requests_total', endpoint=path, status='error')
+                status = None
+            else:
+                metrics.inc('http_requests_total', endpoint=path, status=status)
+                used = headers.get('X-MBX-USED-WEIGHT-1M')
+                if used:
+                    self.budget.sync(int(used))
+                    metrics.set('request_weight_used', int(used))
+                if status == 200:
+                    return payload
+                if status in (418, 429):
+                    metrics.inc('http_rate_limited_total', endpoint=path, status=status)
+                    retry_after = headers.get('Retry-After')
+                    self.budget.pause(float(retry_after) if retry_after else self._delay(attempt))
+                    continue
+                if status < 500:
+                    break
+            if attempt < self.max_retries:
+                metrics.inc('http_retries_total', endpoint=path)
+                time.sleep(self._delay(attempt))
+        metrics.inc('http_failures_total', endpoint=path)
+        logger.error('Failed to fetch %s %s Status code: %s', path, params or '', status,
+                     extra={'endpoint': path, 'status': status})
+        return None
+
+    def fetch_klines(self, symbol, interval='1h', limit=500, **params):
+        params = dict(symbol=symbol, interval=interval, limit=limit, **params)
+        return self.request('/api/v3/klines', params, weight=kline_weight(limit))
+
+    def fetch_range(self, symbol, interval='1h', start_ms=None, end_ms=None):
+        # Paginated backfill for cold starts and gaps, oldest candle first
+        klines = []
+        while True:
+            params = {'startTime': start_ms}
+            if end_ms is not None:
+                params['endTime'] = end_ms
+            page = self.fetch_klines(symbol, interval, limit=KLINES_PAGE_LIMIT, **params)
+            if page is None:
+                return klines or None
+            klines.extend(page)
+            if len(page) < KLINES_PAGE_LIMIT:
+                return klines
+            start_ms = page[-1][0] + INTERVAL_MS[interval]
+
+    @timed('fetch_klines')
+    def fetch_since(self, symbol, interval='1h', start_ms=None):
+        # Candles from start_ms (the last stored open time) onwards. The candle at
+        # start_ms is requested again because it may still have been forming.
+        interval_ms = INTERVAL_MS[interval]
+        now_ms = int(time.time() * 1000)
+        if start_ms is None:
+            return self.fetch_range(symbol, interval, now_ms - BACKFILL_CANDLES * interval_ms)
+        expected = (now_ms - start_ms) // interval_ms + 1
+        if expected > KLINES_PAGE_LIMIT:
+            return self.fetch_range(symbol, interval, start_ms)
+        return self.fetch_klines(symbol, interval, limit=max(expected, 1), startTime=start_ms)
+
+_fetcher = None
+
+def get_fetcher():
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = KlineFetcher()
+    return _fetcher
+
+def set_fetcher(fetcher):
+    global _fetcher
+    _fetcher = fetcher
+
+# The symbols worth trading are chosen from exchangeInfo and the 24h ticker stats of
+# every symbol, each fetched in one request and cached for UNIVERSE_TTL seconds
+UNIVERSE_TTL = 3600
+# 24h volume in the quote asset below which a symbol is not traded
+UNIVERSE_MIN_QUOTE_VOLUME = 1_000_000
+# Matched against the base asset: stablecoins. Leveraged tokens are recognised by
+# their LEVERAGED permission instead, since names like SYRUP end the same way.
+UNIVERSE_EXCLUDE = (r'^(USDC|FDUSD|TUSD|BUSD|USDP|DAI|PAX)$',)
+
+SymbolInfo = namedtuple('SymbolInfo', ['symbol', 'base_asset', 'quote_asset', 'status', 'permissions', 'quote_volume'])
+
+class SymbolUniverse:
+    # Symbol metadata, refreshed every ttl seconds, and the symbols that pass the
+    # filters, most liquid first. A failed refresh keeps the previous metadata and
+    # is retried on the next call.
+    def __init__(self, quote_asset='USDT', statuses=('TRADING',), min_quote_volume=UNIVERSE_MIN_QUOTE_VOLUME,
+                 exclude=UNIVERSE_EXCLUDE, top_n=None, ttl=UNIVERSE_TTL):
+        self.quote_asset = quote_asset
+        self.statuses = set(statuses)
+        self.min_quote_volume = min_quote_volume
+        self.exclude = [re.compile(pattern) for pattern in exclude]
+        self.top_n = top_n
+        self.ttl = ttl
+        self.metadata = {}
+        self.selected = []
+        self.refreshed_at = None
+
+    def refresh(self):
+        fetcher = get_fetcher()
+        info = fetcher.request('/api/v3/exchangeInfo', weight=20)
+        # Without a symbol parameter the 24h ticker covers every symbol in one response
+        stats = info and fetcher.request('/api/v3/ticker/24hr', {'type': 'MINI'}, weight=80)
+        if info is None or stats is None:
+            logger.warning('Could not refresh symbol metadata; keeping %d cached symbols', len(self.selected))
+            return False
+        volumes = {item['symbol']: float(item['quoteVolume']) for item in stats}
+        metadata = {}
+        for item in info['symbols']:
+            permissions = set(item.get('permissions') or ())
+            for permission_set in item.get('permissionSets') or ():
+                permissions.update(permission_set)
+            metadata[item['symbol']] = SymbolInfo(item['symbol'], item['baseAsset'], item['quoteAsset'], item['status'],
+                                                  frozenset(permissions), volumes.get(item['symbol'], 0.0))
+        self.metadata = metadata
+        self.selected = self.select()
+        self.refreshed_at = time.time()
+        get_metrics().set('universe_symbols', len(self.selected))
+        logger.info('Trading %d of %d symbols', len(self.selected), len(metadata))
+        return True
+
+    def accepts(self, info):
+        return (info.quote_asset == self.quote_asset
+                and info.status in self.statuses
+                and 'LEVERAGED' not in info.permissions
+                and info.quote_volume >= self.min_quote_volume
+                and not any(pattern.search(info.base_asset) for pattern in self.exclude))
+
+    def select(self):
+        chosen = sorted((info for info in self.metadata.values() if self.accepts(info)),
+                        key=lambda info: info.quote_volume, reverse=True)
+        return [info.symbol for info in chosen[:self.top_n]]
+
+    def symbols(self):
+        if self.refreshed_at is None or time.time() - self.refreshed_at >= self.ttl:
+            self.refresh()
+        return list(self.selected)
+
+    def info(self, symbol):
+        return self.metadata.get(symbol)
+
+_universe = None
+
+def get_universe():
+    global _universe
+    if _universe is None:
+        _universe = SymbolUniverse()
+    return _universe
+
+def set_universe(universe):
+    global _universe
+    _universe = universe
+
+# USDT pairs to trade, from the cached symbol universe
+@timed('fetch_usdt_pairs')
 def fetch_usdt_pairs():
-    try:
-        response = requests.get('https://api.binance.com/api/v3/ticker/price')
-        if response.status_code == 200:
-            symbols = [item['symbol'] for item in response.json() if item['symbol'].endswith('USDT')]
-            return symbols
-        else:
-            print(f"Failed to fetch symbols. Status code: {response.status_code}")
-            return []
-    except Exception as e:
-        print(f"Error fetching symbols: {e}")
-        return []
+    return get_universe().symbols()
 
+@timed('fetch_crypto_data')
 def fetch_crypto_data(symbol, interval='1h'):
-    try:
-        # Fetch real-time data for the specified symbol
-        response = requests.get(f'https://api.binance.com/api/v3/klines?symbol={symbol}&interval={interval}')
-        if response.status_code == 200:
-            data = response.json()
-            return data
-        else:
-            print(f'Failed to fetch data for symbol: {symbol} Status code: {response.status_code}')
-            return None
-    except Exception as e:
-        print(f"Error fetching data: {e}")
-        return None
+    # Fetch real-time data for the specified symbol
+    return get_fetcher().fetch_klines(symbol, interval)
+
+BINANCE_STREAM = 'wss://stream.binance.com:9443'
+
+# Binance accepts up to 1024 streams per connection; fewer keeps the URL short and
+# limits how many symbols a single dropped socket takes down
+STREAMS_PER_CONNECTION = 200
+
+def websocket_client():
+    # websockets is only needed in stream mode, so it is imported on first use
+    from websockets.sync.client import connect
+    return lambda url: connect(url, max_size=None, open_timeout=10)
+
+class ReplayConnection:
+    # Stand-in for a websocket that plays back frames recorded with KlineStream(record=...),
+    # one JSON frame per line, keeping only the streams named in the URL
+    def __init__(self, path, url, delay=0):
+        self.path = path
+        self.streams = set(url.split('streams=', 1)[1].split('/'))
+        self.delay = delay
+        self.closed = False
+
+    def __iter__(self):
+        with open(self.path) as f:
+            for line in f:
+                if self.closed:
+                    return
+                if line.strip() and json.loads(line).get('stream') in self.streams:
+                    if self.delay:
+                        time.sleep(self.delay)
+                    yield line
+
+    def close(self):
+        self.closed = True
+
+def replay_connect(path, delay=0):
+    return lambda url: ReplayConnection(path, url, delay)
+
+def recorded_symbols(path):
+    with open(path) as f:
+        return sorted({json.loads(line)['data']['s'] for line in f if line.strip()})
+
+def stream_kline(k):
+    # A kline event's payload in the /api/v3/klines layout insert_klines_to_db takes
+    return [k['t'], k['o'], k['h'], k['l'], k['c'], k['v'], k['T'], k['q'], k['n'], k['V'], k['Q'], k['B']]
+
+class KlineStream:
+    # Combined kline streams for a list of symbols, STREAMS_PER_CONNECTION per socket
+    # and one thread per socket. Consumers read self.events:
+    #   ('candle', symbol, kline)  a closed candle, in the REST kline layout
+    #   ('connected', symbols)     after every (re)connect; candles may have been missed
+    def __init__(self, symbols, interval='1h', connect=None, base_url=BINANCE_STREAM,
+                 reconnect=True, backoff=0.5, max_backoff=60, record=None):
+        self.chunks = [symbols[i:i + STREAMS_PER_CONNECTION] for i in range(0, len(symbols), STREAMS_PER_CONNECTION)]
+        self.interval = interval
+        self.connect = connect or websocket_client()
+        self.base_url = base_url.rstrip('/')
+        self.reconnect = reconnect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.record = open(record, 'a') if record else None
+        self.events = queue.Queue()
+        self.stopped = threading.Event()
+        self.connections = set()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def url(self, symbols):
+        streams = '/'.join(f'{symbol.lower()}@kline_{self.interval}' for symbol in symbols)
+        return f'{self.base_url}/stream?streams={streams}'
+
+    def start(self):
+        for symbols in self.chunks:
+            thread = threading.Thread(target=self._run, args=(symbols,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def running(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            for connection in list(self.connections):
+                connection.close()
+        for thread in self.threads:
+            thread.join()
+        if self.record:
+            self.record.close()
+
+    def _run(self, symbols):
+        attempt = 0
+        while not self.stopped.is_set():
+            try:
+                connection = self.connect(self.url(symbols))
+            except Exception as e:
+                logger.warning('Error connecting kline stream: %s', e)
+                get_metrics().inc('stream_connect_errors_total')
+            else:
+                with self.lock:
+                    self.connections.add(connection)
+                self.events.put(('connected', symbols))
+                try:
+                    for message in connection:
+                        attempt = 0
+                        self._handle(message)
+                except Exception as e:
+                    if not self.stopped.is_set():
+                        logger.warning('Kline stream disconnected: %s', e)
+                        get_metrics().inc('stream_disconnects_total')
+                finally:
+                    with self.lock:
+                        self.connections.discard(connection)
+                    connection.close()
+            if not self.reconnect:
+                return
+            self.stopped.wait(min(self.max_backoff, self.backoff * 2 ** attempt) * (1 + random.random()))
+            attempt += 1
+
+    def _handle(self, message):
+        if self.record:
+            with self.lock:
+                self.record.write(message.rstrip('\n') + '\n')
+        k = json.loads(message)['data']['k']
+        # Updates for the forming candle are skipped; strategies only act on closed ones
+        if k['x']:
+            self.events.put(('candle', k['s'], stream_kline(k)))
+
+# Connection settings for open_db(). WAL lets readers run while a cycle is being
+# written, and with WAL synchronous=NORMAL only fsyncs at checkpoints.
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,  # negative means KiB, so 64 MiB
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+def open_db(path='crypto_trading.db', **pragmas):
+    conn = sqlite3.connect(path)
+    for name, value in dict(DB_PRAGMAS, **pragmas).items():
+        conn.execute(f'PRAGMA {name}={value}')
+    return conn
+
+# Positions used to be inserted and never closed: only the ones strategy_state still
+# holds are open
+CLOSE_UNHELD_POSITIONS = '''
+    UPDATE positions SET status = 'CLOSED'
+    WHERE status = 'OPEN' AND NOT EXISTS (
+        SELECT 1 FROM strategy_state s
+        WHERE s.strategy = positions.strategy AND s.symbol = positions.symbol
+          AND s.entry_timestamp = positions.entry_timestamp
+    )
+'''
 
 def create_tables(conn):
+    # Timestamps are exchange open times in UTC epoch milliseconds
+    legacy = {row[1] for row in conn.execute('PRAGMA table_info(raw_data)')}
+    if legacy and 'interval' not in legacy:
+        raise RuntimeError('this database still has text timestamps; run "python migrate_db.py" once to convert it')
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS raw_data (
-            symbol TEXT,
-            timestamp DATETIME,
+            symbol TEXT NOT NULL,
+            interval TEXT NOT NULL DEFAULT '1h',
+            timestamp INTEGER NOT NULL,
             open REAL,
             high REAL,
             low REAL,
@@ -64,27 +678,34 @@ def create_tables(conn):
             sma_200 REAL,
             obv REAL,
             adx REAL,
-            PRIMARY KEY (symbol, timestamp)
-        )
+            stoch_k REAL,
+            stoch_d REAL,
+            PRIMARY KEY (symbol, interval, timestamp)
+        ) WITHOUT ROWID
     ''')
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS positions (
             id INTEGER PRIMARY KEY,
+            strategy TEXT,
             symbol TEXT,
-            entry_timestamp DATETIME,
+            entry_timestamp INTEGER,
             entry_price REAL,
             quantity REAL,
-            side TEXT
+            side TEXT,
+            fee REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'OPEN',
+            exit_timestamp INTEGER
         )
     ''')
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS trades (
             id INTEGER PRIMARY KEY,
+            strategy TEXT,
             symbol TEXT,
-            entry_timestamp DATETIME,
-            exit_timestamp DATETIME,
+            entry_timestamp INTEGER,
+            exit_timestamp INTEGER,
             entry_price REAL,
             exit_price REAL,
             quantity REAL,
@@ -98,8 +719,8 @@ def create_tables(conn):
             id INTEGER PRIMARY KEY,
             strategy TEXT,
             symbol TEXT,
-            entry_timestamp DATETIME,
-            exit_timestamp DATETIME,
+            entry_timestamp INTEGER,
+            exit_timestamp INTEGER,
             entry_price REAL,
             exit_price REAL,
             quantity REAL,
@@ -108,386 +729,1685 @@ def create_tables(conn):
         )
     ''')
 
-    conn.commit()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS indicator_state (
+            symbol TEXT,
+            interval TEXT DEFAULT '1h',
+            last_timestamp INTEGER,
+            state TEXT,
+            PRIMARY KEY (symbol, interval)
+        )
+    ''')
 
-def insert_klines_to_db(conn, symbol, klines):
-    cursor = conn.cursor()
-    for kline in klines:
-        timestamp = datetime.fromtimestamp(kline[0] / 1000.0)
-        cursor.execute('''
-            INSERT OR IGNORE INTO raw_data (
-                symbol, timestamp, open, high, low, close, volume, quote_asset_volume, number_of_trades,
-                taker_buy_base_asset_volume, taker_buy_quote_asset_volume, ignore
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            symbol,
-            timestamp,
-            float(kline[1]),
-            float(kline[2]),
-            float(kline[3]),
-            float(kline[4]),
-            float(kline[5]),
-            float(kline[7]),
-            int(kline[8]),
-            float(kline[9]),
-            float(kline[10]),
-            int(kline[11])
-        ))
-    conn.commit()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS strategy_state (
+            strategy TEXT,
+            symbol TEXT,
+            balance REAL,
+            entry_timestamp INTEGER,
+            entry_price REAL,
+            quantity REAL,
+            last_timestamp INTEGER,
+            PRIMARY KEY (strategy, symbol)
+        )
+    ''')
 
-def calculate_indicators(conn, symbol):
-    cursor = conn.cursor()
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(positions)')}
+    if 'status' not in columns:
+        cursor.execute('ALTER TABLE positions ADD COLUMN fee REAL NOT NULL DEFAULT 0')
+        cursor.execute("ALTER TABLE positions ADD COLUMN status TEXT NOT NULL DEFAULT 'OPEN'")
+        cursor.execute('ALTER TABLE positions ADD COLUMN exit_timestamp INTEGER')
+        cursor.execute(CLOSE_UNHELD_POSITIONS)
     cursor.execute('''
-        SELECT timestamp, close, high, low, volume
-        FROM raw_data
-        WHERE symbol = ?
-        ORDER BY timestamp ASC
-    ''', (symbol,))
-    rows = cursor.fetchall()
-
-    if len(rows) > 0:
-        df = pd.DataFrame(rows, columns=['timestamp', 'close', 'high', 'low', 'volume'])
-        df['close'] = pd.to_numeric(df['close'])
-        df['volume'] = pd.to_numeric(df['volume'])
-        df['high'] = pd.to_numeric(df['high'])
-        df['low'] = pd.to_numeric(df['low'])
-
-        ema_short = EMAIndicator(close=df['close'], window=12).ema_indicator()
-        ema_long = EMAIndicator(close=df['close'], window=26).ema_indicator()
-        rsi = RSIIndicator(close=df['close'], window=14).rsi()
-        macd = MACD(close=df['close'], window_slow=26, window_fast=12, window_sign=9).macd_diff()
-        bb = BollingerBands(close=df['close'], window=20, window_dev=2)
-        bb_high = bb.bollinger_hband()
-        bb_low = bb.bollinger_lband()
-        sma_50 = df['close'].rolling(window=50).mean()
-        sma_200 = df['close'].rolling(window=200).mean()
-        obv = (df['volume'] * ((df['close'].diff() > 0) * 2 - 1)).cumsum()
-        adx = ADXIndicator(high=df['high'], low=df['low'], close=df['close'], window=14).adx()
-
-        df['ema_short'] = ema_short
-        df['ema_long'] = ema_long
-        df['rsi'] = rsi
-        df['macd'] = macd
-        df['bb_high'] = bb_high
-        df['bb_low'] = bb_low
-        df['sma_50'] = sma_50
-        df['sma_200'] = sma_200
-        df['obv'] = obv
-        df['adx'] = adx
-
-        df.dropna(inplace=True)
-        
-        for row in df.itertuples():
-            cursor.execute('''
-                UPDATE raw_data
-                SET ema_short=?, ema_long=?, rsi=?, macd=?, bb_high=?, bb_low=?, sma_50=?, sma_200=?, obv=?, adx=?
-                WHERE symbol=? AND timestamp=?
-            ''', (row.ema_short, row.ema_long, row.rsi, row.macd, row.bb_high, row.bb_low, row.sma_50, row.sma_200, row.obv, row.adx, symbol, row.timestamp))
-            conn.commit()
+        CREATE INDEX IF NOT EXISTS positions_open
+        ON positions (strategy, symbol) WHERE status = 'OPEN'
+    ''')
 
-def execute_strategy(conn, strategy_name, strategy_func):
-    cursor = conn.cursor()
-    usdt_pairs = fetch_usdt_pairs()
-    for symbol in usdt_pairs:
-        klines = fetch_crypto_data(symbol)
-        if klines:
-            insert_klines_to_db(conn, symbol, klines)
-            calculate_indicators(conn, symbol)
-            strategy_func(conn, symbol, strategy_name)
-            
-def ema_crossover_strategy(conn, symbol, strategy_name):
-    cursor = conn.cursor()
+    # Written by optimize.py: one row per parameter combination and walk-forward fold,
+    # ranked by training P&L within the fold
     cursor.execute('''
-        SELECT symbol, timestamp, close, ema_short, ema_long
-        FROM raw_data
-        WHERE symbol = ?
-        ORDER BY timestamp ASC
-    ''', (symbol,))
-    rows = cursor.fetchall()
-
-    balance = 1000  # Starting balance
-    position = None
-
-    for row in rows:
-        symbol, timestamp, close, ema_short, ema_long = row
-        
-        # Check if any indicator is None
-        if any(x is None for x in [ema_short, ema_long]):
-            continue  # Skip this iteration if any indicator is None
-
-        # Define buy and sell conditions based on indicators
-        buy_condition = (ema_short > ema_long)
-        sell_condition = (ema_short < ema_long)
-
-        if buy_condition and balance >= 10 and not position:
-            quantity = 10 / close
-            cursor.execute('''
-                INSERT INTO positions (symbol, entry_timestamp, entry_price, quantity, side)
-                VALUES (?, ?, ?, ?, 'BUY')
-            ''', (symbol, timestamp, close, quantity))
-            conn.commit()
-            position = (symbol, timestamp, close, quantity)
-            balance -= 10
-            print(f"Buy signal for {symbol} at {timestamp} at price {close}")
-
-        if sell_condition and position:
-            entry_symbol, entry_timestamp, entry_price, quantity = position
-            profit_loss = (close - entry_price) * quantity
-            profit_percent = (profit_loss / (entry_price * quantity)) * 100
-            balance += (quantity * close)
-
-            cursor.execute('''
-                INSERT INTO trades (symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            cursor.execute('''
-                INSERT INTO strategy_results (strategy, symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (strategy_name, symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            print(f"Sell signal for {symbol} at {timestamp} at price {close} with P&L: {profit_loss}, {profit_percent}%")
-            position = None
-
-def rsi_overbought_oversold_strategy(conn, symbol, strategy_name):
-    cursor = conn.cursor()
+        CREATE TABLE IF NOT EXISTS optimization_results (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER,
+            strategy TEXT,
+            params TEXT,
+            fold INTEGER,
+            train_start INTEGER,
+            train_end INTEGER,
+            test_start INTEGER,
+            test_end INTEGER,
+            train_profit REAL,
+            train_trades INTEGER,
+            train_win_rate REAL,
+            test_profit REAL,
+            test_trades INTEGER,
+            test_win_rate REAL,
+            rank INTEGER
+        )
+    ''')
     cursor.execute('''
-        SELECT symbol, timestamp, close, rsi
-        FROM raw_data
-        WHERE symbol = ?
-        ORDER BY timestamp ASC
-    ''', (symbol,))
-    rows = cursor.fetchall()
-
-    balance = 1000  # Starting balance
-    position = None
-
-    for row in rows:
-        symbol, timestamp, close, rsi = row
-        
-        # Check if any indicator is None
-        if rsi is None:
-            continue  # Skip this iteration if RSI is None
-
-        # Define buy and sell conditions based on RSI
-        buy_condition = (rsi < 30)
-        sell_condition = (rsi > 70)
-
-        if buy_condition and balance >= 10 and not position:
-            quantity = 10 / close
-            cursor.execute('''
-                INSERT INTO positions (symbol, entry_timestamp, entry_price, quantity, side)
-                VALUES (?, ?, ?, ?, 'BUY')
-            ''', (symbol, timestamp, close, quantity))
-            conn.commit()
-            position = (symbol, timestamp, close, quantity)
-            balance -= 10
-            print(f"Buy signal for {symbol} at {timestamp} at price {close}")
-
-        if sell_condition and position:
-            entry_symbol, entry_timestamp, entry_price, quantity = position
-            profit_loss = (close - entry_price) * quantity
-            profit_percent = (profit_loss / (entry_price * quantity)) * 100
-            balance += (quantity * close)
-
-            cursor.execute('''
-                INSERT INTO trades (symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            cursor.execute('''
-                INSERT INTO strategy_results (strategy, symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (strategy_name, symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            print(f"Sell signal for {symbol} at {timestamp} at price {close} with P&L: {profit_loss}, {profit_percent}%")
-            position = None
-
-def simple_strategy(conn, symbol, strategy_name):
+        CREATE INDEX IF NOT EXISTS optimization_results_rank
+        ON optimization_results (run_id, strategy, fold, rank)
+    ''')
+
+    for table in ('positions', 'trades', 'strategy_results'):
+        cursor.execute(f'''
+            CREATE UNIQUE INDEX IF NOT EXISTS {table}_entry
+            ON {table} (strategy, symbol, entry_timestamp)
+        ''')
+    # Closed trades are looked up and reported by when they were closed
+    for table in ('trades', 'strategy_results'):
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {table}_exit
+            ON {table} (strategy, symbol, exit_timestamp)
+        ''')
+
+    conn.commit()
+
+# Trade inserts are keyed on (strategy, symbol, entry_timestamp), so re-running
+# bars that were already recorded cannot duplicate them. A position row is written
+# once with its latest status, however often it changed since the last flush.
+SAVE_POSITION = '''
+    INSERT INTO positions (strategy, symbol, entry_timestamp, entry_price, quantity, side, fee, status, exit_timestamp)
+    VALUES (?, ?, ?, ?, ?, 'BUY', ?, ?, ?)
+    ON CONFLICT (strategy, symbol, entry_timestamp) DO UPDATE SET status = excluded.status, exit_timestamp = excluded.exit_timestamp
+'''
+
+INSERT_TRADE = '''
+    INSERT OR IGNORE INTO trades (strategy, symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_STRATEGY_RESULT = '''
+    INSERT OR IGNORE INTO strategy_results (strategy, symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+SAVE_STRATEGY_STATE = '''
+    INSERT OR REPLACE INTO strategy_state (strategy, symbol, balance, entry_timestamp, entry_price, quantity, last_timestamp)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+class WriteBatch:
+    # Rows queued per statement, written with executemany in a single transaction.
+    # portfolio is the Portfolio strategies trade on in code without a connection to
+    # look it up by, i.e. the pipeline's worker processes.
+    def __init__(self, portfolio=None):
+        self.statements = {}
+        self.portfolio = portfolio
+
+    def add(self, sql, params):
+        self.statements.setdefault(sql, []).append(params)
+
+    @timed('write_batch')
+    def flush(self, conn):
+        # Also commits anything the connection has executed but not committed yet
+        with conn:
+            for sql, rows in self.statements.items():
+                conn.executemany(sql, rows)
+        self.statements.clear()
+
+@timed('insert_klines_to_db')
+def insert_klines_to_db(conn, symbol, klines, commit=True, interval='1h'):
+    # Upsert, so the still-forming last candle picks up its latest high/low/close/volume
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT symbol, timestamp, close, ema_short, ema_long, rsi, macd, bb_high, bb_low, sma_50, sma_200, obv, adx
+    cursor.executemany('''
+        INSERT INTO raw_data (
+            symbol, interval, timestamp, open, high, low, close, volume, quote_asset_volume, number_of_trades,
+            taker_buy_base_asset_volume, taker_buy_quote_asset_volume, ignore
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (symbol, interval, timestamp) DO UPDATE SET
+            open=excluded.open, high=excluded.high, low=excluded.low, close=excluded.close,
+            volume=excluded.volume, quote_asset_volume=excluded.quote_asset_volume,
+            number_of_trades=excluded.number_of_trades,
+            taker_buy_base_asset_volume=excluded.taker_buy_base_asset_volume,
+            taker_buy_quote_asset_volume=excluded.taker_buy_quote_asset_volume,
+            ignore=excluded.ignore
+    ''', [(
+        symbol,
+        interval,
+        int(kline[0]),
+        float(kline[1]),
+        float(kline[2]),
+        float(kline[3]),
+        float(kline[4]),
+        float(kline[5]),
+        float(kline[7]),
+        int(kline[8]),
+        float(kline[9]),
+        float(kline[10]),
+        int(kline[11])
+    ) for kline in klines])
+    if commit:
+        conn.commit()
+
+def get_high_water_marks(conn, interval='1h'):
+    # Last stored open time per symbol
+    cursor = conn.cursor()
+    cursor.execute('SELECT symbol, MAX(timestamp) FROM raw_data WHERE interval = ? GROUP BY symbol', (interval,))
+    return dict(cursor.fetchall())
+
+def ms_to_timestamp(ms):
+    # For messages only; the database keeps the milliseconds
+    return datetime.fromtimestamp(ms / 1000.0, tz=timezone.utc)
+
+def backfill_klines(conn, symbol, start_ms, end_ms=None, interval='1h', store=None):
+    # Separate mode for loading history or repairing a gap in raw_data
+    klines = get_fetcher().fetch_range(symbol, interval, start_ms, end_ms)
+    if klines:
+        insert_klines_to_db(conn, symbol, klines, interval=interval)
+        reset_indicator_state(conn, symbol, interval)
+        if store is not None:
+            store.load_from_db(conn, symbol, interval)
+        calculate_indicators(conn, symbol, store=store, interval=interval)
+    return len(klines or [])
+
+# raw_data columns taken from an /api/v3/klines row, with their index in the row
+KLINE_FIELDS = {
+    'timestamp': 0, 'open': 1, 'high': 2, 'low': 3, 'close': 4, 'volume': 5, 'quote_asset_volume': 7,
+    'number_of_trades': 8, 'taker_buy_base_asset_volume': 9, 'taker_buy_quote_asset_volume': 10, 'ignore': 11,
+}
+
+def kline_frame(klines):
+    frame = pd.DataFrame({column: [kline[i] for kline in klines] for column, i in KLINE_FIELDS.items()})
+    return frame.astype({column: np.int64 if column in ('timestamp', 'number_of_trades', 'ignore') else np.float64
+                         for column in KLINE_FIELDS})
+
+def resample_klines(candles, interval):
+    # Aggregate consecutive candles (KLINE_FIELDS columns, oldest first) into bars of
+    # a longer interval, returned as /api/v3/klines rows. A bar covers whatever candles
+    # of its bucket are given, so the newest one may still be forming.
+    interval_ms = INTERVAL_MS[interval]
+    timestamps = candles['timestamp'].to_numpy()
+    if not len(timestamps):
+        return []
+    buckets = timestamps - timestamps % interval_ms
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)] - 1
+    column = {name: candles[name].to_numpy() for name in KLINE_FIELDS}
+    total = {name: np.add.reduceat(column[name], starts).tolist() for name in
+             ['volume', 'quote_asset_volume', 'number_of_trades', 'taker_buy_base_asset_volume',
+              'taker_buy_quote_asset_volume']}
+    open_times = buckets[starts].tolist()
+    return [list(row) for row in zip(
+        open_times, column['open'][starts].tolist(), np.maximum.reduceat(column['high'], starts).tolist(),
+        np.minimum.reduceat(column['low'], starts).tolist(), column['close'][ends].tolist(), total['volume'],
+        [open_time + interval_ms - 1 for open_time in open_times], total['quote_asset_volume'],
+        total['number_of_trades'], total['taker_buy_base_asset_volume'], total['taker_buy_quote_asset_volume'],
+        [0] * len(starts),
+    )]
+
+def derive_klines(conn, symbol, klines, interval, base_interval='1h'):
+    # Bars of a longer interval for base klines that are about to be written: every
+    # bucket they touch, rebuilt from them and the stored base candles earlier in the
+    # same bucket. Buckets starting before the first base candle would be partial and
+    # are left to the REST history.
+    if not klines:
+        return []
+    interval_ms = INTERVAL_MS[interval]
+    new = kline_frame(klines)
+    first = int(new['timestamp'].iloc[0])
+    stored = pd.read_sql_query(f'''
+        SELECT {', '.join(KLINE_FIELDS)}
         FROM raw_data
-        WHERE symbol = ?
+        WHERE symbol = ? AND interval = ? AND timestamp >= ? AND timestamp < ?
         ORDER BY timestamp ASC
-    ''', (symbol,))
-    rows = cursor.fetchall()
-
-    balance = 1000  # Starting balance
-    position = None
-
-    for row in rows:
-        symbol, timestamp, close, ema_short, ema_long, rsi, macd, bb_high, bb_low, sma_50, sma_200, obv, adx = row
-        
-        # Check if any indicator is None
-        if any(x is None for x in [ema_short, ema_long, rsi, macd, bb_high, bb_low, sma_50, sma_200, obv, adx]):
-            continue  # Skip this iteration if any indicator is None
-
-        # Define buy and sell conditions based on indicators
-        buy_condition = (ema_short > ema_long) and (rsi < 30) and (macd > 0) and (close > bb_low) and (adx > 25)
-        sell_condition = (ema_short < ema_long) and (rsi > 70) and (macd < 0) and (close < bb_high) and (adx > 25)
-
-        if buy_condition and balance >= 10 and not position:
-            quantity = 10 / close
-            cursor.execute('''
-                INSERT INTO positions (symbol, entry_timestamp, entry_price, quantity, side)
-                VALUES (?, ?, ?, ?, 'BUY')
-            ''', (symbol, timestamp, close, quantity))
-            conn.commit()
-            position = (symbol, timestamp, close, quantity)
-            balance -= 10
-            print(f"Buy signal for {symbol} at {timestamp} at price {close}")
-
-        if sell_condition and position:
-            entry_symbol, entry_timestamp, entry_price, quantity = position
-            profit_loss = (close - entry_price) * quantity
-            profit_percent = (profit_loss / (entry_price * quantity)) * 100
-            balance += (quantity * close)
-
-            cursor.execute('''
-                INSERT INTO trades (symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            cursor.execute('''
-                INSERT INTO strategy_results (strategy, symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (strategy_name, symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            print(f"Sell signal for {symbol} at {timestamp} at price {close} with P&L: {profit_loss}, {profit_percent}%")
-            position = None
-
-def stochastic_oscillator_strategy(conn, symbol, strategy_name):
+    ''', conn, params=(symbol, base_interval, first - first % interval_ms, first))
+    oldest = conn.execute('SELECT MIN(timestamp) FROM raw_data WHERE symbol = ? AND interval = ?',
+                          (symbol, base_interval)).fetchone()[0]
+    oldest = first if oldest is None else min(oldest, first)
+    candles = pd.concat([stored.astype(new.dtypes.to_dict()), new], ignore_index=True) if len(stored) else new
+    return resample_klines(candles[candles['timestamp'] >= -(-oldest // interval_ms) * interval_ms], interval)
+
+INDICATOR_COLUMNS = ['ema_short', 'ema_long', 'rsi', 'macd', 'bb_high', 'bb_low', 'sma_50', 'sma_200', 'obv', 'adx']
+
+# Written with the columns above but NULL where undefined, e.g. %K over a flat high/low range
+OPTIONAL_INDICATOR_COLUMNS = ['stoch_k', 'stoch_d']
+
+def compute_indicator_frame(df):
+    # Full-history indicators from the ta library; the reference the engine is checked against
+    df = df.copy()
+    df['close'] = pd.to_numeric(df['close'])
+    df['volume'] = pd.to_numeric(df['volume'])
+    df['high'] = pd.to_numeric(df['high'])
+    df['low'] = pd.to_numeric(df['low'])
+
+    bb = BollingerBands(close=df['close'], window=20, window_dev=2)
+    df['ema_short'] = EMAIndicator(close=df['close'], window=12).ema_indicator()
+    df['ema_long'] = EMAIndicator(close=df['close'], window=26).ema_indicator()
+    df['rsi'] = RSIIndicator(close=df['close'], window=14).rsi()
+    df['macd'] = MACD(close=df['close'], window_slow=26, window_fast=12, window_sign=9).macd_diff()
+    df['bb_high'] = bb.bollinger_hband()
+    df['bb_low'] = bb.bollinger_lband()
+    df['sma_50'] = df['close'].rolling(window=50).mean()
+    df['sma_200'] = df['close'].rolling(window=200).mean()
+    df['obv'] = (df['volume'] * ((df['close'].diff() > 0) * 2 - 1)).cumsum()
+    df['adx'] = ADXIndicator(high=df['high'], low=df['low'], close=df['close'], window=14).adx()
+    stochastic = StochasticOscillator(high=df['high'], low=df['low'], close=df['close'], window=14, smooth_window=3)
+    df['stoch_k'] = stochastic.stoch().replace([np.inf, -np.inf], np.nan)
+    df['stoch_d'] = stochastic.stoch_signal().replace([np.inf, -np.inf], np.nan)
+    return df
+
+class IndicatorEngine:
+    # Streaming versions of the compute_indicator_frame() indicators. Each candle is
+    # O(1): EMA/Wilder recursions, a ring buffer of closes for SMA/BB, a running OBV,
+    # the ADX DM/TR accumulators and monotonic deques for the stochastic high/low.
+    # The state is a plain dict so it can be stored as JSON and picked up again
+    # after a restart; STATE_VERSION changes whenever its layout does.
+    STATE_VERSION = 2
+    EMA_SHORT = 12
+    EMA_LONG = 26
+    MACD_SIGNAL = 9
+    RSI_WINDOW = 14
+    BB_WINDOW = 20
+    BB_DEV = 2
+    SMA_SHORT = 50
+    SMA_LONG = 200
+    ADX_WINDOW = 14
+    STOCH_WINDOW = 14
+    STOCH_SMOOTH = 3
+
+    def __init__(self, state=None):
+        self.state = state or {
+            'version': self.STATE_VERSION,
+            'count': 0,
+            'closes': [0.0] * self.SMA_LONG,
+            'pos': 0,
+            'sum_short': 0.0,
+            'sum_long': 0.0,
+            'prev_close': None,
+            'prev_high': None,
+            'prev_low': None,
+            'ema_short': None,
+            'ema_long': None,
+            'macd_signal': None,
+            'macd_count': 0,
+            'rsi_up': 0.0,
+            'rsi_down': 0.0,
+            'obv': 0.0,
+            'tr': 0.0,
+            'dm_pos': 0.0,
+            'dm_neg': 0.0,
+            'dx_sum': 0.0,
+            'adx': None,
+            'stoch_highs': [],
+            'stoch_lows': [],
+            'stoch_k': [],
+        }
+        for key in ('stoch_highs', 'stoch_lows'):
+            self.state[key] = deque(self.state[key])
+
+    @classmethod
+    def loads(cls, text):
+        # None for state saved by an older engine, which needs a full recompute
+        state = json.loads(text)
+        if state.get('version') != cls.STATE_VERSION:
+            return None
+        return cls(state)
+
+    def dumps(self):
+        return json.dumps(self.state, default=list)
+
+    @staticmethod
+    def _ewm(previous, value, alpha):
+        # Same recursion as pandas ewm(adjust=False)
+        return ((1 - alpha) * previous + alpha * value) / ((1 - alpha) + alpha)
+
+    def _window(self, size):
+        closes, pos = self.state['closes'], self.state['pos']
+        return [closes[(pos - i) % self.SMA_LONG] for i in range(size, 0, -1)]
+
+    def update(self, close, high, low, volume):
+        s = self.state
+        n = s['count']
+        values = dict.fromkeys(INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS)
+
+        # EMA 12/26 and MACD histogram
+        if n == 0:
+            s['ema_short'] = s['ema_long'] = close
+        else:
+            s['ema_short'] = self._ewm(s['ema_short'], close, 2 / (self.EMA_SHORT + 1))
+            s['ema_long'] = self._ewm(s['ema_long'], close, 2 / (self.EMA_LONG + 1))
+        if n >= self.EMA_SHORT - 1:
+            values['ema_short'] = s['ema_short']
+        if n >= self.EMA_LONG - 1:
+            values['ema_long'] = s['ema_long']
+            macd = s['ema_short'] - s['ema_long']
+            if s['macd_signal'] is None:
+                s['macd_signal'] = macd
+            else:
+                s['macd_signal'] = self._ewm(s['macd_signal'], macd, 2 / (self.MACD_SIGNAL + 1))
+            s['macd_count'] += 1
+            if s['macd_count'] >= self.MACD_SIGNAL:
+                values['macd'] = macd - s['macd_signal']
+
+        # RSI with Wilder smoothing; the first candle counts as no change
+        if n > 0:
+            diff = close - s['prev_close']
+            alpha = 1 / self.RSI_WINDOW
+            s['rsi_up'] = self._ewm(s['rsi_up'], diff if diff > 0 else 0.0, alpha)
+            s['rsi_down'] = self._ewm(s['rsi_down'], -diff if diff < 0 else 0.0, alpha)
+        if n >= self.RSI_WINDOW - 1:
+            if s['rsi_down'] == 0:
+                values['rsi'] = 100.0
+            else:
+                values['rsi'] = 100 - 100 / (1 + s['rsi_up'] / s['rsi_down'])
+
+        # SMA 50/200 as running sums over the ring buffer, re-summed once per lap to stop drift
+        closes = s['closes']
+        for key, size in (('sum_short', self.SMA_SHORT), ('sum_long', self.SMA_LONG)):
+            leaving = closes[(s['pos'] - size) % self.SMA_LONG] if n >= size else 0.0
+            s[key] += close - leaving
+        closes[s['pos']] = close
+        s['pos'] = (s['pos'] + 1) % self.SMA_LONG
+        if s['pos'] == 0:
+            s['sum_short'] = math.fsum(self._window(min(n + 1, self.SMA_SHORT)))
+            s['sum_long'] = math.fsum(self._window(min(n + 1, self.SMA_LONG)))
+        if n >= self.SMA_SHORT - 1:
+            values['sma_50'] = s['sum_short'] / self.SMA_SHORT
+        if n >= self.SMA_LONG - 1:
+            values['sma_200'] = s['sum_long'] / self.SMA_LONG
+
+        # Bollinger Bands use the population standard deviation, like ta
+        if n >= self.BB_WINDOW - 1:
+            window = self._window(self.BB_WINDOW)
+            mean = math.fsum(window) / self.BB_WINDOW
+            std = math.sqrt(math.fsum((x - mean) ** 2 for x in window) / self.BB_WINDOW)
+            values['bb_high'] = mean + self.BB_DEV * std
+            values['bb_low'] = mean - self.BB_DEV * std
+
+        # OBV counts an unchanged close as selling volume
+        if n > 0 and close > s['prev_close']:
+            s['obv'] += volume
+        else:
+            s['obv'] -= volume
+        values['obv'] = s['obv']
+
+        # ADX: Wilder sums of TR/+DM/-DM seeded with the first window, then ADX seeded
+        # with the mean of the first window of DX values, as ta's ADXIndicator does
+        w = self.ADX_WINDOW
+        if n > 0:
+            true_range = max(high, s['prev_close']) - min(low, s['prev_close'])
+            up = high - s['prev_high']
+            down = s['prev_low'] - low
+            dm_pos = up if up > down and up > 0 else 0.0
+            dm_neg = down if down > up and down > 0 else 0.0
+            if n <= w:
+                s['tr'] += true_range
+                s['dm_pos'] += dm_pos
+                s['dm_neg'] += dm_neg
+            else:
+                s['tr'] = s['tr'] - s['tr'] / w + true_range
+                s['dm_pos'] = s['dm_pos'] - s['dm_pos'] / w + dm_pos
+                s['dm_neg'] = s['dm_neg'] - s['dm_neg'] / w + dm_neg
+            if n >= w:
+                di_pos = 100 * s['dm_pos'] / s['tr'] if s['tr'] != 0 else 0.0
+                di_neg = 100 * s['dm_neg'] / s['tr'] if s['tr'] != 0 else 0.0
+                dx = 100 * abs((di_pos - di_neg) / (di_pos + di_neg)) if di_pos + di_neg != 0 else 0.0
+                if n < 2 * w - 1:
+                    s['dx_sum'] += dx
+                elif n == 2 * w - 1:
+                    s['adx'] = (s['dx_sum'] + dx) / w
+                else:
+                    s['adx'] = (s['adx'] * (w - 1) + dx) / w
+        if s['adx'] is not None:
+            values['adx'] = s['adx']
+
+        # Stochastic %K/%D: the deques hold [index, value] pairs with values kept
+        # monotonic, so the window high/low is always at the front (O(1) amortized)
+        w = self.STOCH_WINDOW
+        highs, lows = s['stoch_highs'], s['stoch_lows']
+        while highs and highs[-1][1] <= high:
+            highs.pop()
+        highs.append([n, high])
+        while lows and lows[-1][1] >= low:
+            lows.pop()
+        lows.append([n, low])
+        while highs[0][0] <= n - w:
+            highs.popleft()
+        while lows[0][0] <= n - w:
+            lows.popleft()
+        if n >= w - 1:
+            highest, lowest = highs[0][1], lows[0][1]
+            stoch_k = 100 * (close - lowest) / (highest - lowest) if highest != lowest else None
+            s['stoch_k'] = (s['stoch_k'] + [stoch_k])[-self.STOCH_SMOOTH:]
+            values['stoch_k'] = stoch_k
+            if len(s['stoch_k']) == self.STOCH_SMOOTH and None not in s['stoch_k']:
+                values['stoch_d'] = math.fsum(s['stoch_k']) / self.STOCH_SMOOTH
+
+        s['prev_close'] = close
+        s['prev_high'] = high
+        s['prev_low'] = low
+        s['count'] = n + 1
+        return values
+
+UPDATE_INDICATORS = '''
+    UPDATE raw_data
+    SET ema_short=?, ema_long=?, rsi=?, macd=?, bb_high=?, bb_low=?, sma_50=?, sma_200=?, obv=?, adx=?,
+        stoch_k=?, stoch_d=?
+    WHERE symbol=? AND interval=? AND timestamp=?
+'''
+
+SAVE_INDICATOR_STATE = '''
+    INSERT OR REPLACE INTO indicator_state (symbol, interval, last_timestamp, state)
+    VALUES (?, ?, ?, ?)
+'''
+
+@timed('advance_indicators')
+def advance_indicators(engine, rows, symbol, interval):
+    # Feed (timestamp, close, high, low, volume) rows to the engine. Returns the
+    # UPDATE_INDICATORS parameters and the engine state from before the last row.
+    updates = []
+    for i, (timestamp, close, high, low, volume) in enumerate(rows):
+        if i == len(rows) - 1:
+            state = engine.dumps()
+        values = engine.update(close, high, low, volume)
+        # Only rows with every indicator warmed up are written, as before
+        if all(values[column] is not None for column in INDICATOR_COLUMNS):
+            updates.append([values[column] for column in INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS] + [symbol, interval, timestamp])
+    return updates, state
+
+@timed('calculate_indicators')
+def calculate_indicators(conn, symbol, commit=True, store=None, interval='1h'):
+    # Advance the symbol's saved IndicatorEngine over candles it has not seen. The
+    # saved state is from before the newest candle, so re-reading that candle
+    # (it may have been forming) replaces its values instead of counting it twice.
+    # With a CandleStore the candles are read from it, and the results go to both.
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT symbol, timestamp, close, high, low
+    cursor.execute('SELECT last_timestamp, state FROM indicator_state WHERE symbol = ? AND interval = ?',
+                   (symbol, interval))
+    saved = cursor.fetchone()
+    engine = IndicatorEngine.loads(saved[1]) if saved else None
+    if store is not None:
+        candles = store.read(symbol, interval, start_ms=saved[0] if engine else None,
+                             columns=['close', 'high', 'low', 'volume'])
+        rows = list(zip(candles['timestamp'].tolist(), candles['close'].tolist(),
+                        candles['high'].tolist(), candles['low'].tolist(), candles['volume'].tolist()))
+        engine = engine or IndicatorEngine()
+    elif engine:
+        cursor.execute('''
+            SELECT timestamp, close, high, low, volume
+            FROM raw_data
+            WHERE symbol = ? AND interval = ? AND timestamp >= ?
+            ORDER BY timestamp ASC
+        ''', (symbol, interval, saved[0]))
+    else:
+        engine = IndicatorEngine()
+        cursor.execute('''
+            SELECT timestamp, close, high, low, volume
+            FROM raw_data
+            WHERE symbol = ? AND interval = ?
+            ORDER BY timestamp ASC
+        ''', (symbol, interval))
+    if store is None:
+        rows = cursor.fetchall()
+    if not rows:
+        return
+
+    updates, state = advance_indicators(engine, rows, symbol, interval)
+    cursor.executemany(UPDATE_INDICATORS, updates)
+    if store is not None and updates:
+        columns = INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS
+        store.upsert(symbol, interval, [update[-1] for update in updates],
+                     {column: [update[i] for update in updates] for i, column in enumerate(columns)})
+    cursor.execute(SAVE_INDICATOR_STATE, (symbol, interval, rows[-1][0], state))
+    if commit:
+        conn.commit()
+
+def reset_indicator_state(conn, symbol, interval='1h'):
+    # Needed when older candles are inserted behind the engine, e.g. by a backfill
+    conn.execute('DELETE FROM indicator_state WHERE symbol = ? AND interval = ?', (symbol, interval))
+    conn.commit()
+
+def verify_indicators(conn, symbol, tolerance=1e-6, interval='1h'):
+    # Compare stored indicators with a full ta recomputation. Returns the worst
+    # relative error per column that is out of tolerance (empty when everything matches).
+    df = pd.read_sql_query('''
+        SELECT *
         FROM raw_data
-        WHERE symbol = ?
+        WHERE symbol = ? AND interval = ?
         ORDER BY timestamp ASC
-    ''', (symbol,))
-    rows = cursor.fetchall()
-
-    balance = 1000  # Starting balance
-    position = None
-
-    for row in rows:
-        symbol, timestamp, close, high, low = row
-
-        # Calculate stochastic oscillator
-        if len(rows) >= 14:
-            close_prices = [r[2] for r in rows[:14]]
-            stochastic_value = (close - min(close_prices)) / (max(close_prices) - min(close_prices)) * 100
-
-            # Define buy and sell conditions based on stochastic oscillator
-            buy_condition = (stochastic_value < 20)
-            sell_condition = (stochastic_value > 80)
-
-            if buy_condition and balance >= 10 and not position:
-                quantity = 10 / close
-                cursor.execute('''
-                    INSERT INTO positions (symbol, entry_timestamp, entry_price, quantity, side)
-                    VALUES (?, ?, ?, ?, 'BUY')
-                ''', (symbol, timestamp, close, quantity))
-                conn.commit()
-                position = (symbol, timestamp, close, quantity)
-                balance -= 10
-                print(f"Buy signal for {symbol} at {timestamp} at price {close}")
-
-            if sell_condition and position:
-                entry_symbol, entry_timestamp, entry_price, quantity = position
-                profit_loss = (close - entry_price) * quantity
-                profit_percent = (profit_loss / (entry_price * quantity)) * 100
-                balance += (quantity * close)
-
-                cursor.execute('''
-                    INSERT INTO trades (symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-                conn.commit()
-
-                cursor.execute('''
-                    INSERT INTO strategy_results (strategy, symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (strategy_name, symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-                conn.commit()
-
-                print(f"Sell signal for {symbol} at {timestamp} at price {close} with P&L: {profit_loss}, {profit_percent}%")
-                position = None
-
-def moving_average_crossover_strategy(conn, symbol, strategy_name):
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT symbol, timestamp, close, sma_50, sma_200
+    ''', conn, params=(symbol, interval))
+    expected = compute_indicator_frame(df[['timestamp', 'close', 'high', 'low', 'volume']])
+    ready = expected[INDICATOR_COLUMNS].notna().all(axis=1)
+    mismatches = {}
+    for column in INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS:
+        stored = pd.to_numeric(df[column][ready])
+        wanted = expected[column][ready]
+        error = ((stored - wanted).abs() / wanted.abs().clip(lower=1.0)).max()
+        if (stored.isna() != wanted.isna()).any() or error > tolerance:
+            mismatches[column] = float(error)
+    return mismatches
+
+# Indicators IndicatorCache can compute: functions of a candle frame (CACHE_CANDLE_COLUMNS)
+# and their parameters that return a NumPy array aligned with its rows, NaN while
+# warming up. The second element is how many earlier candles a recomputation of the
+# tail needs to reproduce the full-history values: the window for rolling indicators,
+# and for recursive ones enough for the seed's weight to fall below float precision.
+def ema_values(candles, window):
+    return EMAIndicator(close=candles['close'], window=window).ema_indicator().to_numpy()
+
+def sma_values(candles, window):
+    return candles['close'].rolling(window=window).mean().to_numpy()
+
+def rsi_values(candles, window):
+    return RSIIndicator(close=candles['close'], window=window).rsi().to_numpy()
+
+def macd_diff_values(candles, fast, slow, signal):
+    return MACD(close=candles['close'], window_slow=slow, window_fast=fast, window_sign=signal).macd_diff().to_numpy()
+
+def bb_high_values(candles, window, dev):
+    return BollingerBands(close=candles['close'], window=window, window_dev=dev).bollinger_hband().to_numpy()
+
+def bb_low_values(candles, window, dev):
+    return BollingerBands(close=candles['close'], window=window, window_dev=dev).bollinger_lband().to_numpy()
+
+def adx_values(candles, window):
+    return ADXIndicator(high=candles['high'], low=candles['low'], close=candles['close'], window=window).adx().to_numpy()
+
+def stoch_k_values(candles, window):
+    k = StochasticOscillator(high=candles['high'], low=candles['low'], close=candles['close'], window=window).stoch()
+    return k.replace([np.inf, -np.inf], np.nan).to_numpy()
+
+INDICATOR_FUNCTIONS = {
+    'ema': (ema_values, lambda window: 40 * window),
+    'sma': (sma_values, lambda window: window),
+    'rsi': (rsi_values, lambda window: 40 * window),
+    'macd_diff': (macd_diff_values, lambda fast, slow, signal: 40 * (slow + signal)),
+    'bb_high': (bb_high_values, lambda window, dev: window),
+    'bb_low': (bb_low_values, lambda window, dev: window),
+    'adx': (adx_values, lambda window: 80 * window),
+    'stoch_k': (stoch_k_values, lambda window: window),
+}
+
+CACHE_CANDLE_COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+class IndicatorCache:
+    # Indicator arrays keyed by (symbol, interval, indicator, params), next to the candle
+    # series they were computed from. An entry remembers how many leading candles it is
+    # still valid for, so new or changed candles only cost a recomputation of the tail.
+    # Series and arrays share one LRU order and are evicted once they exceed max_bytes.
+    def __init__(self, max_bytes=256 * 2**20, conn=None):
+        self.max_bytes = max_bytes
+        self.conn = conn
+        self.series = {}
+        self.values = {}
+        self.keys = {}
+        self.lru = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.tails = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'tail_recomputes': self.tails, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.values), 'nbytes': self.nbytes}
+
+    def _touch(self, key, nbytes):
+        # Evict the least recently used entries until the cache fits, but never the
+        # series of the entry being touched: an indicator array that does not fit next
+        # to its own series is returned without being kept
+        self.nbytes += nbytes - self.lru.pop(key, 0)
+        self.lru[key] = nbytes
+        for oldest in list(self.lru):
+            if self.nbytes <= self.max_bytes:
+                return
+            if oldest in (key, key[:2]) or oldest not in self.lru:
+                continue
+            self._drop(oldest)
+            self.evictions += 1
+        if self.nbytes > self.max_bytes and len(key) > 2:
+            self._drop(key)
+
+    def _drop(self, key):
+        self.nbytes -= self.lru.pop(key, 0)
+        if len(key) == 2:
+            # Without its candles a series' arrays cannot be extended, so they go too
+            self.series.pop(key, None)
+            for value_key in self.keys.pop(key, set()):
+                self.nbytes -= self.lru.pop(value_key, 0)
+                self.values.pop(value_key, None)
+        else:
+            self.values.pop(key, None)
+            self.keys.get(key[:2], set()).discard(key)
+
+    def update(self, symbol, interval, candles, conn=None):
+        # Merge candles (CACHE_CANDLE_COLUMNS, oldest first) into the cached series. When
+        # the series does not reach the first of them, the older history is read from
+        # the database, if there is a connection; otherwise the candles replace it.
+        key = (symbol, interval)
+        candles = candles[CACHE_CANDLE_COLUMNS].reset_index(drop=True)
+        if not len(candles):
+            return
+        conn = conn or self.conn
+        first = int(candles['timestamp'].iloc[0])
+        series = self.series.get(key)
+        if series is None or not len(series) or int(series['timestamp'].iloc[-1]) < first:
+            self._drop(key)
+            if conn is not None:
+                older = pd.read_sql_query(f'''
+                    SELECT {', '.join(CACHE_CANDLE_COLUMNS)}
+                    FROM raw_data
+                    WHERE symbol = ? AND interval = ? AND timestamp < ?
+                    ORDER BY timestamp ASC
+                ''', conn, params=(symbol, interval, first))
+                candles = pd.concat([older, candles], ignore_index=True) if len(older) else candles
+            series, changed = candles.astype({column: np.float64 for column in CACHE_CANDLE_COLUMNS[1:]}), 0
+        else:
+            start = int(np.searchsorted(series['timestamp'].to_numpy(), first))
+            overlap = series.iloc[start:].to_numpy()
+            incoming = candles.iloc[:len(overlap)].to_numpy(dtype=np.float64)
+            differs = np.flatnonzero((overlap[:len(incoming)] != incoming).any(axis=1))
+            changed = start + int(differs[0]) if len(differs) else start + len(incoming)
+            if len(overlap) > len(candles):
+                changed = min(changed, start + len(candles))
+            if changed == len(series) and len(candles) <= len(overlap):
+                self.lru.move_to_end(key)
+                return
+            series = pd.concat([series.iloc[:start], candles], ignore_index=True)
+        nbytes = int(series.memory_usage(index=False).sum())
+        if nbytes > self.max_bytes:
+            self._drop(key)
+            raise ValueError(f'{len(series)} candles of {symbol} {interval} take {nbytes} bytes, more than '
+                             f'the indicator cache max_bytes of {self.max_bytes}')
+        for value_key in self.keys.get(key, ()):
+            self.values[value_key][0] = min(self.values[value_key][0], changed)
+        self.series[key] = series
+        self._touch(key, nbytes)
+
+    def get(self, symbol, interval, name, *params):
+        key = (symbol, interval)
+        if key not in self.series:
+            raise KeyError(f'no candles cached for {symbol} {interval}; call update() first')
+        series = self.series[key]
+        func, lookback = INDICATOR_FUNCTIONS[name]
+        value_key = key + (name,) + params
+        entry = self.values.get(value_key)
+        if entry is not None and entry[0] == len(series):
+            self.hits += 1
+            self.lru.move_to_end(value_key)
+            self.lru.move_to_end(key)
+            return entry[1]
+        if entry is not None and entry[0] > 0:
+            self.tails += 1
+            start = entry[0]
+            lo = max(0, start - lookback(*params))
+            values = np.concatenate([entry[1][:start], func(series.iloc[lo:], *params)[start - lo:]])
+        else:
+            self.misses += 1
+            values = func(series, *params)
+        self.values[value_key] = [len(series), values]
+        self.keys.setdefault(key, set()).add(value_key)
+        self.lru.move_to_end(key)
+        self._touch(value_key, values.nbytes)
+        return values
+
+_indicator_cache = None
+
+def get_indicator_cache():
+    global _indicator_cache
+    if _indicator_cache is None:
+        _indicator_cache = IndicatorCache()
+    return _indicator_cache
+
+def set_indicator_cache(cache):
+    global _indicator_cache
+    _indicator_cache = cache
+
+def snapshot_indicator(conn, symbol, snapshot, name, *params, interval='1h'):
+    # Any INDICATOR_FUNCTIONS indicator, computed over the symbol's whole history and
+    # aligned with the snapshot's rows; for strategies that need more than the stored
+    # indicator columns. The snapshot brings the cache up to date with the newest candles.
+    if not len(snapshot):
+        return np.empty(0)
+    cache = get_indicator_cache()
+    cache.update(symbol, interval, snapshot, conn)
+    timestamps = cache.series[(symbol, interval)]['timestamp'].to_numpy()
+    values = cache.get(symbol, interval, name, *params)
+    return values[np.searchsorted(timestamps, snapshot['timestamp'].to_numpy())]
+
+def init_indicator_cache(path):
+    # Pipeline workers have no connection of their own; give their cache a read-only one
+    if path:
+        set_indicator_cache(IndicatorCache(conn=sqlite3.connect(f'file:{path}?mode=ro', uri=True)))
+
+def init_worker(path, log_settings):
+    # Pipeline worker setup: the parent's logging settings and a cache connection
+    if log_settings is not None:
+        configure_logging(*log_settings)
+    init_indicator_cache(path)
+
+# Columns CandleStore keeps next to the int64 open times
+CANDLE_STORE_COLUMNS = ['open', 'high', 'low', 'close', 'volume'] + INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS
+
+class CandleStore:
+    # Optional columnar copy of raw_data: one memory-mapped .npy file per column in
+    # root/<symbol>/<interval>/, so any time slice can be read as NumPy views without
+    # going through SQLite. Files are over-allocated and doubled when full, which keeps
+    # appends cheap; meta.json records how many rows are in use.
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, root):
+        self.root = root
+        self.series = {}
+
+    def _path(self, symbol, interval, name=''):
+        return os.path.join(self.root, symbol, interval, name)
+
+    def _open(self, symbol, interval):
+        key = (symbol, interval)
+        if key not in self.series:
+            length, arrays = 0, None
+            meta = self._path(symbol, interval, 'meta.json')
+            if os.path.exists(meta):
+                with open(meta) as f:
+                    length = json.load(f)['length']
+                arrays = {column: np.load(self._path(symbol, interval, column + '.npy'), mmap_mode='r+')
+                          for column in ['timestamp'] + CANDLE_STORE_COLUMNS}
+            self.series[key] = [length, arrays]
+        return self.series[key]
+
+    def _grow(self, symbol, interval, capacity):
+        series = self._open(symbol, interval)
+        length, old = series
+        os.makedirs(self._path(symbol, interval), exist_ok=True)
+        arrays = {}
+        for column in ['timestamp'] + CANDLE_STORE_COLUMNS:
+            path = self._path(symbol, interval, column + '.npy')
+            dtype = np.int64 if column == 'timestamp' else np.float64
+            array = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=(capacity,))
+            if column != 'timestamp':
+                array[:] = np.nan
+            if old is not None:
+                array[:length] = old[column][:length]
+            array.flush()
+            del array
+            os.replace(path + '.tmp', path)
+            arrays[column] = np.load(path, mmap_mode='r+')
+        series[1] = arrays
+
+    def _save_length(self, symbol, interval, length):
+        meta = self._path(symbol, interval, 'meta.json')
+        with open(meta + '.tmp', 'w') as f:
+            json.dump({'length': length}, f)
+        os.replace(meta + '.tmp', meta)
+
+    def length(self, symbol, interval='1h'):
+        return self._open(symbol, interval)[0]
+
+    def upsert(self, symbol, interval, timestamps, columns):
+        # Overwrites rows whose open time is already stored and appends newer ones.
+        # Candles older than the last stored one can only go in through load_from_db().
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not len(timestamps):
+            return
+        length, arrays = self._open(symbol, interval)
+        stored = arrays['timestamp'][:length] if arrays is not None else np.empty(0, dtype=np.int64)
+        rows = np.searchsorted(stored, timestamps)
+        existing = rows < length
+        existing[existing] = stored[rows[existing]] == timestamps[existing]
+        added = int((~existing).sum())
+        if added and length and timestamps[~existing][0] <= stored[-1]:
+            raise ValueError(f'{symbol} {interval}: candles older than the stored range need load_from_db()')
+        if arrays is None or length + added > len(arrays['timestamp']):
+            self._grow(symbol, interval, max(self.INITIAL_CAPACITY, 2 * (length + added)))
+            arrays = self._open(symbol, interval)[1]
+        rows[~existing] = np.arange(length, length + added)
+        arrays['timestamp'][rows] = timestamps
+        for column, values in columns.items():
+            arrays[column][rows] = np.asarray(values, dtype=np.float64)
+        if added:
+            self.series[(symbol, interval)][0] = length + added
+            self._save_length(symbol, interval, length + added)
+
+    def read(self, symbol, interval='1h', start_ms=None, end_ms=None, columns=None):
+        # Zero-copy views of the candles with start_ms <= open time <= end_ms
+        columns = ['timestamp'] + (columns or CANDLE_STORE_COLUMNS)
+        length, arrays = self._open(symbol, interval)
+        if arrays is None:
+            return {column: np.empty(0, dtype=np.int64 if column == 'timestamp' else np.float64) for column in columns}
+        stored = arrays['timestamp'][:length]
+        lo = 0 if start_ms is None else int(np.searchsorted(stored, start_ms, 'left'))
+        hi = length if end_ms is None else int(np.searchsorted(stored, end_ms, 'right'))
+        return {column: arrays[column][lo:hi] for column in columns}
+
+    def load_from_db(self, conn, symbol, interval='1h'):
+        # (Re)build a symbol's columns from raw_data, e.g. on first use or after a backfill
+        self.series.pop((symbol, interval), None)
+        shutil.rmtree(self._path(symbol, interval), ignore_errors=True)
+        df = pd.read_sql_query(f'''
+            SELECT timestamp, {', '.join(CANDLE_STORE_COLUMNS)}
+            FROM raw_data
+            WHERE symbol = ? AND interval = ?
+            ORDER BY timestamp ASC
+        ''', conn, params=(symbol, interval))
+        self.upsert(symbol, interval, df['timestamp'], {column: df[column].astype(float) for column in CANDLE_STORE_COLUMNS})
+
+    def add_klines(self, conn, symbol, klines, interval='1h'):
+        # Mirror klines that were just written to raw_data. The files are rebuilt when
+        # they are missing, or stale because raw_data got candles past their end that
+        # these klines do not bring, e.g. from runs without the store
+        length, arrays = self._open(symbol, interval)
+        if length == 0:
+            self.load_from_db(conn, symbol, interval)
+            return
+        last = int(arrays['timestamp'][length - 1])
+        newer = sum(kline[0] > last for kline in klines)
+        stored = conn.execute('SELECT COUNT(*) FROM raw_data WHERE symbol = ? AND interval = ? AND timestamp > ?',
+                              (symbol, interval, last)).fetchone()[0]
+        if min(kline[0] for kline in klines) - last > INTERVAL_MS[interval] or stored > newer:
+            self.load_from_db(conn, symbol, interval)
+            return
+        self.upsert(symbol, interval, [kline[0] for kline in klines], {
+            column: [float(kline[i]) for kline in klines]
+            for i, column in enumerate(['open', 'high', 'low', 'close', 'volume'], start=1)
+        })
+
+    def flush(self):
+        for _, arrays in self.series.values():
+            for array in (arrays or {}).values():
+                array.flush()
+
+# Strategies run by run_cycle, in registration order
+STRATEGIES = []
+
+# Intervals each strategy reads: it trades on the bars of the first, and the others
+# are added to its snapshot as columns (see add_timeframes)
+STRATEGY_INTERVALS = {}
+
+def register_strategy(strategy_name, strategy_func, intervals=('1h',)):
+    STRATEGIES.append((strategy_name, strategy_func))
+    STRATEGY_INTERVALS[strategy_name] = tuple(intervals)
+    return strategy_func
+
+def strategy_intervals(strategy_name):
+    # Strategies passed in without being registered trade on 1h bars
+    return STRATEGY_INTERVALS.get(strategy_name, ('1h',))
+
+def plan_intervals(strategies, base_interval='1h'):
+    # Every interval the strategies read, shortest first. Only base_interval is
+    # fetched; the others are aggregated from it, so they must be multiples of it.
+    intervals = {base_interval}
+    for strategy_name, _ in strategies:
+        for interval in strategy_intervals(strategy_name):
+            if interval not in INTERVAL_MS or INTERVAL_MS[interval] % INTERVAL_MS[base_interval]:
+                raise ValueError(f"{strategy_name} reads {interval} bars, which cannot be built from "
+                                 f"{base_interval} candles")
+            intervals.add(interval)
+    return sorted(intervals, key=INTERVAL_MS.get)
+
+def fetch_symbol(symbol, marks, base_interval='1h'):
+    # {interval: klines} for one symbol from its high-water marks: the new base candles,
+    # and REST history for longer intervals that aggregation cannot fill, because they
+    # were never stored or their last bar ends before the stored base candles do
+    fetcher = get_fetcher()
+    base_mark = marks[base_interval]
+    klines = {base_interval: fetcher.fetch_since(symbol, base_interval, base_mark)}
+    reach = base_mark if base_mark is not None else time.time() * 1000
+    for interval, mark in marks.items():
+        if interval != base_interval and (mark is None or mark + INTERVAL_MS[interval] <= reach):
+            klines[interval] = fetcher.fetch_since(symbol, interval, mark) or []
+    return klines
+
+def fetch_symbols(conn, symbols, intervals, base_interval='1h'):
+    # fetch_symbol for many symbols on the fetcher's threads; failed symbols are left out
+    marks = {interval: get_high_water_marks(conn, interval) for interval in intervals}
+    fetcher = get_fetcher()
+    with ThreadPoolExecutor(max_workers=fetcher.max_workers) as executor:
+        results = executor.map(lambda symbol: fetch_symbol(
+            symbol, {interval: marks[interval].get(symbol) for interval in intervals}, base_interval), symbols)
+        return {symbol: klines for symbol, klines in zip(symbols, results) if klines[base_interval]}
+
+def interval_klines(conn, symbol, klines, intervals, base_interval='1h', history=None):
+    # The klines to write per interval: the base klines as fetched, and for the longer
+    # intervals any REST history merged with the bars aggregated from the base klines,
+    # which replace the REST bars they overlap
+    history = history or {}
+    result = {base_interval: klines}
+    for interval in intervals:
+        if interval != base_interval:
+            bars = {kline[0]: kline for kline in history.get(interval) or []}
+            bars.update((kline[0], kline) for kline in derive_klines(conn, symbol, klines, interval, base_interval))
+            result[interval] = sorted(bars.values(), key=lambda kline: kline[0])
+    return result
+
+def add_timeframes(snapshot, frames):
+    # Columns from the bars of other intervals, suffixed with the interval (close_4h,
+    # rsi_4h), as of each row's close: a row only sees bars that had closed by then
+    if not frames:
+        return snapshot
+    key = '_close_ms'
+    interval = snapshot['interval'].iloc[0] if len(snapshot) else '1h'
+    merged = snapshot.assign(**{key: snapshot['timestamp'] + INTERVAL_MS[interval]})
+    columns = ['open', 'high', 'low', 'close', 'volume'] + INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS
+    for interval, frame in frames.items():
+        other = frame[columns].add_suffix('_' + interval)
+        other[key] = frame['timestamp'] + INTERVAL_MS[interval]
+        merged = pd.merge_asof(merged, other, on=key)
+    return merged.drop(columns=key)
+
+def load_snapshot(conn, symbol, since=None, store=None, interval='1h'):
+    # Everything the strategies need for a symbol, read once per cycle; with since,
+    # only the bars after that timestamp
+    if store is not None:
+        snapshot = pd.DataFrame(store.read(symbol, interval, start_ms=since + 1 if since else None))
+        snapshot.insert(0, 'symbol', symbol)
+        snapshot.insert(1, 'interval', interval)
+        return snapshot
+    snapshot = pd.read_sql_query('''
+        SELECT *
         FROM raw_data
-        WHERE symbol = ?
+        WHERE symbol = ? AND interval = ? AND timestamp > ?
         ORDER BY timestamp ASC
-    ''', (symbol,))
-    rows = cursor.fetchall()
-
-    balance = 1000  # Starting balance
-    position = None
-
-    for row in rows:
-        symbol, timestamp, close, sma_50, sma_200 = row
-
-        # Check if any indicator is None
-        if any(x is None for x in [sma_50, sma_200]):
-            continue  # Skip this iteration if any indicator is None
-
-        # Define buy and sell conditions based on moving average crossover
-        buy_condition = (sma_50 > sma_200)
-        sell_condition = (sma_50 < sma_200)
-
-        if buy_condition and balance >= 10 and not position:
-            quantity = 10 / close
-            cursor.execute('''
-                INSERT INTO positions (symbol, entry_timestamp, entry_price, quantity, side)
-                VALUES (?, ?, ?, ?, 'BUY')
-            ''', (symbol, timestamp, close, quantity))
-            conn.commit()
-            position = (symbol, timestamp, close, quantity)
-            balance -= 10
-            print(f"Buy signal for {symbol} at {timestamp} at price {close}")
-
-        if sell_condition and position:
-            entry_symbol, entry_timestamp, entry_price, quantity = position
-            profit_loss = (close - entry_price) * quantity
-            profit_percent = (profit_loss / (entry_price * quantity)) * 100
-            balance += (quantity * close)
-
-            cursor.execute('''
-                INSERT INTO trades (symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            cursor.execute('''
-                INSERT INTO strategy_results (strategy, symbol, entry_timestamp, exit_timestamp, entry_price, exit_price, quantity, profit_loss, profit_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (strategy_name, symbol, entry_timestamp, timestamp, entry_price, close, quantity, profit_loss, profit_percent))
-            conn.commit()
-
-            print(f"Sell signal for {symbol} at {timestamp} at price {close} with P&L: {profit_loss}, {profit_percent}%")
-            position = None
+    ''', conn, params=(symbol, interval, since or 0))
+    return numeric_snapshot(snapshot)
+
+def numeric_snapshot(snapshot):
+    # Columns that are still entirely NULL come back as object dtype; casting only
+    # those keeps the one-candle snapshots of stream mode cheap
+    dtypes = {'timestamp': np.int64, **{column: np.float64 for column in
+              ['open', 'high', 'low', 'close', 'volume'] + INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS}}
+    casts = {column: dtype for column, dtype in dtypes.items() if snapshot[column].dtype != dtype}
+    return snapshot.astype(casts) if casts else snapshot
+
+def process_klines(conn, symbol, klines, strategies=None, store=None, as_of_ms=None, base_interval='1h',
+                   history=None):
+    # One transaction per symbol: the base klines and the bars of every longer interval
+    # the strategies read, their indicator columns and the strategy output. as_of_ms
+    # is the exchange time the klines are known to be closed at; history holds REST
+    # klines of the longer intervals from fetch_symbol.
+    if strategies is None:
+        strategies = STRATEGIES
+    started = time.perf_counter()
+    metrics = get_metrics()
+    batch = WriteBatch()
+    intervals = plan_intervals(strategies, base_interval)
+    for interval, rows in interval_klines(conn, symbol, klines, intervals, base_interval, history).items():
+        insert_klines_to_db(conn, symbol, rows, commit=False, interval=interval)
+        if store is not None and rows:
+            store.add_klines(conn, symbol, rows, interval)
+        calculate_indicators(conn, symbol, commit=False, store=store, interval=interval)
+    for interval in intervals:
+        group = [(name, func) for name, func in strategies if strategy_intervals(name)[0] == interval]
+        if not group:
+            continue
+        watermark = strategy_watermark(conn, symbol, [name for name, _ in group])
+        contexts = {context for name, _ in group for context in strategy_intervals(name)[1:]}
+        snapshot = add_timeframes(load_snapshot(conn, symbol, watermark, store, interval), {
+            context: load_snapshot(conn, symbol, None if watermark is None else watermark - 2 * INTERVAL_MS[context], store, context)
+            for context in sorted(contexts, key=INTERVAL_MS.get)})
+        if as_of_ms is not None:
+            snapshot.attrs['as_of_ms'] = as_of_ms
+        for strategy_name, strategy_func in group:
+            with metrics.timer('strategy_seconds', strategy=strategy_name):
+                strategy_func(conn, symbol, strategy_name, snapshot, batch)
+    batch.flush(conn)
+    metrics.observe('symbol_cycle_seconds', time.perf_counter() - started)
+
+def run_cycle(conn, strategies=None, store=None, base_interval='1h'):
+    # Fetch the universe and klines once, then hand the same snapshot to every strategy
+    if strategies is None:
+        strategies = STRATEGIES
+    with get_metrics().timer('cycle_seconds'):
+        intervals = plan_intervals(strategies, base_interval)
+        usdt_pairs = fetch_usdt_pairs()
+        for symbol, klines in fetch_symbols(conn, usdt_pairs, intervals, base_interval).items():
+            process_klines(conn, symbol, klines[base_interval], strategies, store, base_interval=base_interval,
+                           history=klines)
+        get_portfolio(conn).flush(conn)
+        if store is not None:
+            store.flush()
+
+def run_stream(conn, stream, strategies=None, store=None, gap_fill=True):
+    # Stream mode: each closed candle of the stream's interval goes through indicators
+    # and strategies as soon as it arrives, along with the longer-interval bars it
+    # updates. After every (re)connect the candles that may have been missed are
+    # fetched over REST from the stored high-water marks. The portfolio is written
+    # every PORTFOLIO_FLUSH_SECONDS.
+    portfolio = get_portfolio(conn)
+    stream.start()
+    try:
+        while stream.running() or not stream.events.empty():
+            portfolio.flush(conn, PORTFOLIO_FLUSH_SECONDS)
+            try:
+                event = stream.events.get(timeout=1)
+            except queue.Empty:
+                continue
+            if event[0] == 'connected':
+                if gap_fill:
+                    intervals = plan_intervals(STRATEGIES if strategies is None else strategies, stream.interval)
+                    missed = fetch_symbols(conn, event[1], intervals, stream.interval)
+                    for symbol, klines in missed.items():
+                        process_klines(conn, symbol, klines[stream.interval], strategies, store,
+                                       base_interval=stream.interval, history=klines)
+            else:
+                _, symbol, kline = event
+                get_metrics().inc('stream_candles_total')
+                process_klines(conn, symbol, [kline], strategies, store, as_of_ms=kline[6] + 1,
+                               base_interval=stream.interval)
+    finally:
+        stream.stop()
+        portfolio.flush(conn)
+        if store is not None:
+            store.flush()
+
+SymbolJob = namedtuple('SymbolJob', ['symbol', 'intervals', 'portfolio', 'strategies', 'strategy_intervals'])
+IntervalJob = namedtuple('IntervalJob', ['interval', 'klines', 'rows', 'engine', 'indicator_timestamp'])
+SymbolResult = namedtuple('SymbolResult', ['symbol', 'intervals', 'batch', 'portfolio', 'metrics'])
+IntervalResult = namedtuple('IntervalResult', ['interval', 'klines', 'updates', 'indicator_state'])
+
+def load_symbol_job(conn, symbol, klines, strategies, base_interval='1h'):
+    # What process_klines would read from the database, gathered so compute_symbol
+    # can run without a connection. klines is fetch_symbol's {interval: klines}. For
+    # each interval: the klines to write, indicator state, and the stored rows from
+    # the oldest resume point of the indicators and the strategies reading it (all
+    # rows on a cold start), and the symbol's slice of the portfolio.
+    portfolio = get_portfolio(conn).slice(symbol, [name for name, _ in strategies])
+    reads = {name: strategy_intervals(name) for name, _ in strategies}
+    intervals = plan_intervals(strategies, base_interval)
+    jobs = []
+    for interval, interval_rows in interval_klines(conn, symbol, klines[base_interval], intervals,
+                                                   base_interval, klines).items():
+        saved = conn.execute('SELECT last_timestamp, state FROM indicator_state WHERE symbol = ? AND interval = ?',
+                             (symbol, interval)).fetchone()
+        engine = IndicatorEngine.loads(saved[1]) if saved else None
+        marks = [portfolio.watermark(name, symbol) for name, _ in strategies if interval in reads[name]]
+        start = 0
+        if engine and None not in marks:
+            start = min([saved[0]] + [mark - 2 * INTERVAL_MS[interval] for mark in marks])
+        rows = pd.read_sql_query('''
+            SELECT *
+            FROM raw_data
+            WHERE symbol = ? AND interval = ? AND timestamp >= ?
+            ORDER BY timestamp ASC
+        ''', conn, params=(symbol, interval, start))
+        jobs.append(IntervalJob(interval, interval_rows, rows, engine, saved[0] if engine else None))
+    return SymbolJob(symbol, jobs, portfolio, strategies, reads)
+
+def compute_interval(symbol, job):
+    # Merge one interval's klines into its stored rows and advance the indicators
+    frame = job.rows
+    if job.klines:
+        new = kline_frame(job.klines)
+        new.insert(0, 'symbol', symbol)
+        new.insert(1, 'interval', job.interval)
+        kept = job.rows[~job.rows['timestamp'].isin(new['timestamp'])]
+        frame = pd.concat([kept, new], ignore_index=True) if len(kept) else new.reindex(columns=job.rows.columns)
+    frame = numeric_snapshot(frame.sort_values('timestamp', ignore_index=True))
+
+    timestamps = frame['timestamp'].to_numpy()
+    first = 0 if job.engine is None else int(np.searchsorted(timestamps, job.indicator_timestamp))
+    todo = frame.iloc[first:]
+    rows = list(zip(todo['timestamp'].tolist(), todo['close'].tolist(), todo['high'].tolist(),
+                    todo['low'].tolist(), todo['volume'].tolist()))
+    updates, indicator_state = [], None
+    if rows:
+        updates, state = advance_indicators(job.engine or IndicatorEngine(), rows, symbol, job.interval)
+        indicator_state = (rows[-1][0], state)
+    if updates:
+        columns = INDICATOR_COLUMNS + OPTIONAL_INDICATOR_COLUMNS
+        at = np.searchsorted(timestamps, [update[-1] for update in updates])
+        frame.iloc[at, [frame.columns.get_loc(column) for column in columns]] = np.array(
+            [update[:len(columns)] for update in updates], dtype=float)
+    return frame, IntervalResult(job.interval, job.klines, updates, indicator_state)
+
+def compute_symbol(job):
+    # process_klines without the database, for a worker process: merge the klines into
+    # the stored rows and advance the indicators of every interval, then run the
+    # strategies into a WriteBatch
+    frames, results = {}, []
+    for interval_job in job.intervals:
+        frames[interval_job.interval], result = compute_interval(job.symbol, interval_job)
+        results.append(result)
+
+    batch = WriteBatch(job.portfolio)
+    for interval in frames:
+        group = [(name, func) for name, func in job.strategies if job.strategy_intervals[name][0] == interval]
+        if not group:
+            continue
+        snapshot = frames[interval]
+        marks = [job.portfolio.watermark(name, job.symbol) for name, _ in group]
+        if None not in marks:
+            snapshot = snapshot[snapshot['timestamp'] > min(marks)].reset_index(drop=True)
+        contexts = {context for name, _ in group for context in job.strategy_intervals[name][1:]}
+        snapshot = add_timeframes(snapshot, {context: frames[context]
+                                             for context in sorted(contexts, key=INTERVAL_MS.get)})
+        for strategy_name, strategy_func in group:
+            with get_metrics().timer('strategy_seconds', strategy=strategy_name):
+                strategy_func(None, job.symbol, strategy_name, snapshot, batch)
+    return SymbolResult(job.symbol, results, batch, job.portfolio, get_metrics().drain())
+
+def write_symbol_result(conn, result):
+    # The writes process_klines would have made, in one transaction, with the trades
+    # left in the portfolio to be written behind
+    for interval_result in result.intervals:
+        insert_klines_to_db(conn, result.symbol, interval_result.klines, commit=False,
+                            interval=interval_result.interval)
+    for interval_result in result.intervals:
+        conn.executemany(UPDATE_INDICATORS, interval_result.updates)
+        if interval_result.indicator_state is not None:
+            conn.execute(SAVE_INDICATOR_STATE, (result.symbol, interval_result.interval) + interval_result.indicator_state)
+    result.batch.flush(conn)
+    get_portfolio(conn).merge(result.portfolio)
+    get_metrics().merge(result.metrics)
+
+class Pipeline:
+    # run_cycle with its stages overlapped: klines are fetched on threads, indicators
+    # and strategies run in a process pool sharded by symbol, and the calling thread
+    # is the only one that touches SQLite, reading each job and writing each result
+    def __init__(self, conn, strategies=None, workers=None, report_every=10):
+        self.conn = conn
+        self.strategies = STRATEGIES if strategies is None else strategies
+        # Workers are not forked from this process, which has fetch threads running
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        path = conn.execute('PRAGMA database_list').fetchone()[2]
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                        initializer=init_worker, initargs=(path, _log_settings))
+        self.report_every = report_every
+        self.fetching = {}
+        self.computing = set()
+        self.writing = deque()
+        self.started = {}
+
+    def depths(self):
+        return {'fetch': len(self.fetching), 'compute': len(self.computing), 'write': len(self.writing)}
+
+    def run_cycle(self, base_interval='1h'):
+        with get_metrics().timer('cycle_seconds'):
+            self._run_cycle(base_interval)
+
+    def _run_cycle(self, base_interval):
+        # A symbol's latency runs from its klines arriving to its result being written
+        metrics = get_metrics()
+        intervals = plan_intervals(self.strategies, base_interval)
+        marks = {interval: get_high_water_marks(self.conn, interval) for interval in intervals}
+        with ThreadPoolExecutor(max_workers=get_fetcher().max_workers) as threads:
+            self.fetching = {threads.submit(fetch_symbol, symbol, {interval: marks[interval].get(symbol)
+                                                                   for interval in intervals}, base_interval): symbol
+                             for symbol in fetch_usdt_pairs()}
+            last_report = time.time()
+            while self.fetching or self.computing:
+                done, _ = wait(list(self.fetching) + list(self.computing), timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in self.fetching:
+                        symbol = self.fetching.pop(future)
+                        klines = future.result()
+                        if klines[base_interval]:
+                            self.started[symbol] = time.perf_counter()
+                            job = load_symbol_job(self.conn, symbol, klines, self.strategies, base_interval)
+                            self.computing.add(self.pool.submit(compute_symbol, job))
+                    else:
+                        self.computing.remove(future)
+                        self.writing.append(future.result())
+                if time.time() - last_report >= self.report_every:
+                    logger.info('Pipeline queue depths: %s', self.depths(), extra=self.depths())
+                    last_report = time.time()
+                while self.writing:
+                    result = self.writing.popleft()
+                    write_symbol_result(self.conn, result)
+                    metrics.observe('symbol_cycle_seconds', time.perf_counter() - self.started.pop(result.symbol))
+                for stage, depth in self.depths().items():
+                    metrics.set('pipeline_queue_depth', depth, stage=stage)
+        get_portfolio(self.conn).flush(self.conn)
+
+    def close(self):
+        self.pool.shutdown()
 
+def execute_strategy(conn, strategy_name, strategy_func):
+    run_cycle(conn, [(strategy_name, strategy_func)])
+
+def strategy_watermark(conn, symbol, strategy_names):
+    # Oldest bar any of the strategies has processed; None while one has not run yet
+    portfolio = get_portfolio(conn)
+    marks = [portfolio.watermark(name, symbol) for name in strategy_names]
+    if not marks or None in marks:
+        return None
+    return min(marks)
+
+def closed_bars(snapshot, interval=None):
+    # Only the newest bar can still be forming. Stream mode passes the exchange's close
+    # time as as_of_ms, so a local clock running behind cannot hold a closed candle back.
+    closed = np.ones(len(snapshot), dtype=bool)
+    now_ms = snapshot.attrs.get('as_of_ms', time.time() * 1000)
+    if len(snapshot):
+        interval = interval or snapshot['interval'].iloc[-1]
+        if snapshot['timestamp'].iloc[-1] + INTERVAL_MS[interval] > now_ms:
+            closed[-1] = False
+    return closed
+
+# Paper-trading sizing shared by every strategy
+STARTING_BALANCE = 1000
+POSITION_SIZE = 10
+# Paper-trading costs: the exchange's spot taker fee on each side, and how far past
+# the signal bar's close a market order is assumed to fill
+FEE_RATE = 0.001
+SLIPPAGE = 0.0005
+
+BacktestResult = namedtuple('BacktestResult', [
+    'entry_index', 'exit_index', 'entry_price', 'exit_price', 'quantity',
+    'profit_loss', 'profit_percent', 'balance', 'realized',
+])
+
+def run_backtest(entries, exits, prices, position_size=POSITION_SIZE, initial_balance=STARTING_BALANCE, holding=None,
+                 fee_rate=FEE_RATE, slippage=SLIPPAGE):
+    # Long-only, one position at a time, with no per-bar Python. As in the old loops a
+    # buy is checked before a sell, so a bar with both signals while flat opens and
+    # closes on that bar. entry_index may have one more element than exit_index when
+    # a position is still open at the last bar. Fills are priced as in Portfolio.submit.
+    # holding=(entry_price, quantity, cost) resumes with a position already open; it
+    # is reported with entry index -1.
+    entries = np.asarray(entries, dtype=bool)
+    exits = np.asarray(exits, dtype=bool)
+    prices = np.asarray(prices, dtype=float)
+    n = len(prices)
+    held_initially = holding is not None
+
+    # Holding after each bar is decided by the latest bar with a signal: exits win
+    last_signal = np.maximum.accumulate(np.where(entries | exits, np.arange(n), -1))
+    held = np.where(last_signal >= 0, entries[last_signal] & ~exits[last_signal], held_initially)
+    held_before = np.empty(n, dtype=bool)
+    held_before[:1] = held_initially
+    held_before[1:] = held[:-1]
+    entry_index = np.flatnonzero(entries & ~held_before)
+    exit_index = np.flatnonzero(exits & (held_before | entries))
+
+    entry_price = prices[entry_index] * (1 + slippage)
+    cost = np.full(len(entry_index), float(position_size))
+    quantity = cost * (1 - fee_rate) / entry_price
+    cash = initial_balance
+    if held_initially:
+        entry_index = np.concatenate(([-1], entry_index))
+        entry_price = np.concatenate(([holding[0]], entry_price))
+        quantity = np.concatenate(([holding[1]], quantity))
+        cost = np.concatenate(([holding[2]], cost))
+        cash += holding[2]
+    closed = len(exit_index)
+    exit_price = prices[exit_index] * (1 - slippage)
+    proceeds = quantity[:closed] * exit_price * (1 - fee_rate)
+    profit_loss = proceeds - cost[:closed]
+
+    # Balance only changes through closed trades, so once it is too low to open a
+    # position it stays that way and every later trade is dropped
+    balance_before = cash + np.concatenate(([0.0], np.cumsum(profit_loss)))[:len(entry_index)]
+    affordable = balance_before >= position_size
+    affordable[:held_initially] = True
+    if not affordable.all():
+        keep = int(np.argmin(affordable))
+        entry_index, entry_price, quantity, cost = entry_index[:keep], entry_price[:keep], quantity[:keep], cost[:keep]
+        exit_index, exit_price, proceeds, profit_loss = exit_index[:keep], exit_price[:keep], proceeds[:keep], profit_loss[:keep]
+        closed = len(exit_index)
+
+    profit_percent = profit_loss / cost[:closed] * 100
+
+    cash_flow = np.zeros(n)
+    cash_flow[entry_index[entry_index >= 0]] -= position_size
+    cash_flow[exit_index] += proceeds
+    realized = np.zeros(n)
+    realized[exit_index] = profit_loss
+    return BacktestResult(entry_index, exit_index, entry_price, exit_price, quantity,
+                          profit_loss, profit_percent, initial_balance + np.cumsum(cash_flow), realized)
+
+Order = namedtuple('Order', ['strategy', 'symbol', 'side', 'timestamp', 'price'])
+Fill = namedtuple('Fill', ['strategy', 'symbol', 'side', 'timestamp', 'price', 'quantity', 'fee',
+                           'profit_loss', 'profit_percent'])
+Position = namedtuple('Position', ['entry_timestamp', 'entry_price', 'quantity', 'fee', 'cost'])
+
+# Stream mode writes the portfolio once its oldest unwritten change is this old
+PORTFOLIO_FLUSH_SECONDS = 5
+
+class Portfolio:
+    # The paper-trading book every strategy submits its orders to: balance, open
+    # position, realized P&L and last processed bar per (strategy, symbol), each kept
+    # in a dict. Orders fill at once, long-only with one position per key: buys at
+    # the price plus slippage, sells at the price less it, and each side pays
+    # fee_rate of its notional. Changes are written behind. flush() writes them all
+    # in one transaction, with one strategy_state and positions row per key. Bars
+    # processed after the last flush are processed again after a restart.
+    def __init__(self, position_size=POSITION_SIZE, starting_balance=STARTING_BALANCE,
+                 fee_rate=FEE_RATE, slippage=SLIPPAGE):
+        self.position_size = position_size
+        self.starting_balance = starting_balance
+        self.fee_rate = fee_rate
+        self.slippage = slippage
+        self.balances = {}
+        self.positions = {}
+        self.realized = {}
+        self.watermarks = {}
+        self.batch = WriteBatch()
+        self.dirty = set()
+        self.position_rows = {}
+        self.pending_since = None
+
+    @classmethod
+    def load(cls, conn, **settings):
+        # Rebuild the book from what the last flush wrote. Rows migrated from versions
+        # that did not record a strategy belong to no book.
+        portfolio = cls(**settings)
+        for strategy, symbol, balance, last_timestamp in conn.execute(
+                'SELECT strategy, symbol, balance, last_timestamp FROM strategy_state WHERE strategy IS NOT NULL'):
+            portfolio.balances[(strategy, symbol)] = balance
+            portfolio.watermarks[(strategy, symbol)] = last_timestamp
+        for strategy, symbol, entry_timestamp, entry_price, quantity, fee in conn.execute('''
+                SELECT strategy, symbol, entry_timestamp, entry_price, quantity, fee
+                FROM positions
+                WHERE status = 'OPEN' AND strategy IS NOT NULL
+            '''):
+            portfolio.positions[(strategy, symbol)] = Position(entry_timestamp, entry_price, quantity, fee,
+                                                               entry_price * quantity + fee)
+        for strategy, symbol, profit_loss in conn.execute(
+                'SELECT strategy, symbol, SUM(profit_loss) FROM trades WHERE strategy IS NOT NULL GROUP BY strategy, symbol'):
+            portfolio.realized[(strategy, symbol)] = profit_loss
+        return portfolio
+
+    def balance(self, strategy, symbol):
+        return self.balances.get((strategy, symbol), self.starting_balance)
+
+    def position(self, strategy, symbol):
+        return self.positions.get((strategy, symbol))
+
+    def is_open(self, strategy, symbol):
+        return (strategy, symbol) in self.positions
+
+    def watermark(self, strategy, symbol):
+        return self.watermarks.get((strategy, symbol))
+
+    def unrealized(self, strategy, symbol, price):
+        # P&L of the open position if it were sold at price
+        position = self.positions.get((strategy, symbol))
+        if position is None:
+            return 0.0
+        return position.quantity * price * (1 - self.slippage) * (1 - self.fee_rate) - position.cost
+
+    def _touch(self, key):
+        self.dirty.add(key)
+        if self.pending_since is None:
+            self.pending_since = time.time()
+
+    def submit(self, order):
+        # Fill the order, or return None when it cannot be filled: a buy while a position
+        # is open or the balance is below the position size, or a sell while flat
+        key = (order.strategy, order.symbol)
+        balance = self.balance(*key)
+        if order.side == 'BUY':
+            if key in self.positions or balance < self.position_size:
+                return None
+            price = order.price * (1 + self.slippage)
+            fee = self.position_size * self.fee_rate
+            quantity = self.position_size * (1 - self.fee_rate) / price
+            self.positions[key] = Position(order.timestamp, price, quantity, fee, self.position_size)
+            self.balances[key] = balance - self.position_size
+            self.position_rows[key + (order.timestamp,)] = key + (order.timestamp, price, quantity, fee, 'OPEN', None)
+            self._touch(key)
+            return Fill(order.strategy, order.symbol, 'BUY', order.timestamp, price, quantity, fee, None, None)
+
+        position = self.positions.pop(key, None)
+        if position is None:
+            return None
+        price = order.price * (1 - self.slippage)
+        proceeds = position.quantity * price * (1 - self.fee_rate)
+        profit_loss = proceeds - position.cost
+        profit_percent = profit_loss / position.cost * 100
+        self.balances[key] = balance + proceeds
+        self.realized[key] = self.realized.get(key, 0.0) + profit_loss
+        self.position_rows[key + (position.entry_timestamp,)] = key + (
+            position.entry_timestamp, position.entry_price, position.quantity, position.fee, 'CLOSED', order.timestamp)
+        trade = key + (position.entry_timestamp, order.timestamp, position.entry_price, price, position.quantity,
+                       profit_loss, profit_percent)
+        self.batch.add(INSERT_TRADE, trade)
+        self.batch.add(INSERT_STRATEGY_RESULT, trade)
+        self._touch(key)
+        return Fill(order.strategy, order.symbol, 'SELL', order.timestamp, price, position.quantity,
+                    position.quantity * price - proceeds, profit_loss, profit_percent)
+
+    def advance(self, strategy, symbol, timestamp):
+        # Record the last bar the strategy has processed for the symbol
+        self.watermarks[(strategy, symbol)] = timestamp
+        self._touch((strategy, symbol))
+
+    def slice(self, symbol, strategy_names):
+        # A copy of just these keys, to trade on in a worker process and merge() back
+        part = Portfolio(self.position_size, self.starting_balance, self.fee_rate, self.slippage)
+        for name in strategy_names:
+            key = (name, symbol)
+            for mine, theirs in ((self.balances, part.balances), (self.positions, part.positions),
+                                 (self.realized, part.realized), (self.watermarks, part.watermarks)):
+                if key in mine:
+                    theirs[key] = mine[key]
+        return part
+
+    def merge(self, part):
+        # Take over the changed keys of a slice() and its unwritten changes
+        for key in part.dirty:
+            self.balances[key] = part.balance(*key)
+            self.watermarks[key] = part.watermarks.get(key)
+            if key in part.realized:
+                self.realized[key] = part.realized[key]
+            if key in part.positions:
+                self.positions[key] = part.positions[key]
+            else:
+                self.positions.pop(key, None)
+        for sql, rows in part.batch.statements.items():
+            self.batch.statements.setdefault(sql, []).extend(rows)
+        self.position_rows.update(part.position_rows)
+        self.dirty |= part.dirty
+        if part.pending_since is not None:
+            self.pending_since = min(self.pending_since or part.pending_since, part.pending_since)
+
+    def flush(self, conn, max_age=None):
+        # Write every change since the last flush. With max_age, only once the oldest
+        # of them has waited that many seconds.
+        if self.pending_since is None:
+            return
+        if max_age is not None and time.time() - self.pending_since < max_age:
+            return
+        for key in self.dirty:
+            position = self.positions.get(key)
+            held = (None, None, None) if position is None else tuple(position[:3])
+            self.batch.add(SAVE_STRATEGY_STATE, key + (self.balance(*key),) + held + (self.watermarks.get(key),))
+        for row in self.position_rows.values():
+            self.batch.add(SAVE_POSITION, row)
+        self.batch.flush(conn)
+        self.dirty.clear()
+        self.position_rows.clear()
+        self.pending_since = None
+        metrics = get_metrics()
+        metrics.set('open_positions', len(self.positions))
+        metrics.set('realized_profit_loss', sum(self.realized.values()))
+
+_portfolios = {}
+
+def get_portfolio(conn):
+    # The book of the database behind conn, rebuilt from it the first time it is asked for
+    portfolio = _portfolios.get(conn)
+    if portfolio is None:
+        portfolio = _portfolios[conn] = Portfolio.load(conn)
+    return portfolio
+
+def set_portfolio(conn, portfolio):
+    _portfolios[conn] = portfolio
+
+def run_signal_strategy(conn, symbol, strategy_name, snapshot, buy, sell, batch=None):
+    # Backtest buy/sell masks over the closed bars this strategy has not seen yet,
+    # starting from its balance and open position in the portfolio, and submit the
+    # trades as orders to the portfolio
+    portfolio = batch.portfolio if batch is not None and batch.portfolio is not None else get_portfolio(conn)
+    pending = closed_bars(snapshot)
+    last_timestamp = portfolio.watermark(strategy_name, symbol)
+    if last_timestamp is not None:
+        pending &= (snapshot['timestamp'] > last_timestamp).to_numpy()
+    bars = np.flatnonzero(pending)
+    if not len(bars):
+        return None
+
+    timestamps = snapshot['timestamp'].to_numpy()[bars].tolist()
+    prices = snapshot['close'].to_numpy()[bars]
+    position = portfolio.position(strategy_name, symbol)
+    holding = None if position is None else (position.entry_price, position.quantity, position.cost)
+    result = run_backtest(np.asarray(buy)[bars], np.asarray(sell)[bars], prices, portfolio.position_size,
+                          portfolio.balance(strategy_name, symbol), holding, portfolio.fee_rate, portfolio.slippage)
+    # Formatting a message per signal is only worth it when it will be shown
+    log_signals = logger.isEnabledFor(logging.INFO)
+
+    prices = prices.tolist()
+    exits = result.exit_index.tolist()
+    orders = []
+    for k, entry in enumerate(result.entry_index.tolist()):
+        if entry >= 0:
+            orders.append(Order(strategy_name, symbol, 'BUY', timestamps[entry], prices[entry]))
+        if k < len(exits):
+            orders.append(Order(strategy_name, symbol, 'SELL', timestamps[exits[k]], prices[exits[k]]))
+    fills = {'BUY': 0, 'SELL': 0}
+    for order in orders:
+        fill = portfolio.submit(order)
+        if fill is None:
+            continue
+        fills[fill.side] += 1
+        if not log_signals:
+            continue
+        extra = {'strategy': strategy_name, 'symbol': symbol, 'side': fill.side, 'timestamp': fill.timestamp,
+                 'price': fill.price}
+        if fill.side == 'BUY':
+            logger.info('Buy signal for %s at %s at price %s', symbol, ms_to_timestamp(fill.timestamp), fill.price,
+                        extra=extra)
+        else:
+            extra['profit_loss'] = fill.profit_loss
+            logger.info('Sell signal for %s at %s at price %s with P&L: %s, %s%%', symbol,
+                        ms_to_timestamp(fill.timestamp), fill.price, fill.profit_loss, fill.profit_percent, extra=extra)
+    metrics = get_metrics()
+    for side, count in fills.items():
+        if count:
+            metrics.inc('signals_total', count, strategy=strategy_name, side=side)
+    portfolio.advance(strategy_name, symbol, timestamps[-1])
+
+    if batch is None:
+        portfolio.flush(conn)
+    return result
+
+# Strategies only describe their buy and sell conditions; a missing (NaN)
+# indicator makes every comparison False, so those bars are skipped.
+
+def ema_crossover_strategy(conn, symbol, strategy_name, snapshot, batch=None):
+    buy = snapshot['ema_short'] > snapshot['ema_long']
+    sell = snapshot['ema_short'] < snapshot['ema_long']
+    return run_signal_strategy(conn, symbol, strategy_name, snapshot, buy, sell, batch)
+
+def rsi_overbought_oversold_strategy(conn, symbol, strategy_name, snapshot, batch=None):
+    buy = snapshot['rsi'] < 30
+    sell = snapshot['rsi'] > 70
+    return run_signal_strategy(conn, symbol, strategy_name, snapshot, buy, sell, batch)
+
+def simple_strategy(conn, symbol, strategy_name, snapshot, batch=None):
+    s = snapshot
+    buy = (s['ema_short'] > s['ema_long']) & (s['rsi'] < 30) & (s['macd'] > 0) & (s['close'] > s['bb_low']) & (s['adx'] > 25)
+    sell = (s['ema_short'] < s['ema_long']) & (s['rsi'] > 70) & (s['macd'] < 0) & (s['close'] < s['bb_high']) & (s['adx'] > 25)
+    # The old loop also skipped rows where sma_50, sma_200 or obv were missing
+    ready = s[['sma_50', 'sma_200', 'obv']].notna().all(axis=1)
+    return run_signal_strategy(conn, symbol, strategy_name, snapshot, buy & ready, sell & ready, batch)
+
+def stochastic_oscillator_strategy(conn, symbol, strategy_name, snapshot, batch=None):
+    buy = snapshot['stoch_k'] < 20
+    sell = snapshot['stoch_k'] > 80
+    return run_signal_strategy(conn, symbol, strategy_name, snapshot, buy, sell, batch)
+
+def moving_average_crossover_strategy(conn, symbol, strategy_name, snapshot, batch=None):
+    buy = snapshot['sma_50'] > snapshot['sma_200']
+    sell = snapshot['sma_50'] < snapshot['sma_200']
+    return run_signal_strategy(conn, symbol, strategy_name, snapshot, buy, sell, batch)
+
+register_strategy("Simple Strategy", simple_strategy)
+register_strategy("EMA Crossover Strategy", ema_crossover_strategy)
+register_strategy("RSI Overbought/Oversold Strategy", rsi_overbought_oversold_strategy)
+register_strategy("Moving Average Crossover Strategy", moving_average_crossover_strategy)
+register_strategy("Stochastic Oscillator Strategy", stochastic_oscillator_strategy)
 
 # Main function
 def main():
-    conn = sqlite3.connect('crypto_trading.db')
+    parser = argparse.ArgumentParser(description='Intraday cryptocurrency trading bot')
+    parser.add_argument('--db', metavar='PATH',
+                        help='database to use (default: crypto_trading.db; with --replay-stream a new scratch '
+                             'database, and never crypto_trading.db)')
+    parser.add_argument('--verify-indicators', action='store_true',
+                        help='check stored indicators against a full ta recomputation and exit')
+    parser.add_argument('--candle-store', metavar='DIR',
+                        help='also keep candles and indicators in memory-mapped column files under DIR')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes computing indicators and strategies in polling mode; 1 runs everything '
+                             'in this process (always the case with --candle-store)')
+    parser.add_argument('--stream', action='store_true',
+                        help='follow the websocket kline streams instead of polling every 60 seconds')
+    parser.add_argument('--record-stream', metavar='FILE', help='append every stream frame to FILE')
+    parser.add_argument('--replay-stream', metavar='FILE',
+                        help='run stream mode on frames recorded with --record-stream, without REST gap filling')
+    parser.add_argument('--base-interval', default='1h', choices=list(INTERVAL_MS),
+                        help='the only interval fetched; longer ones the strategies read are aggregated from it')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='INFO logs every buy and sell signal; WARNING leaves only problems')
+    parser.add_argument('--log-json', action='store_true', help='log one JSON object per line')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve counters and latency histograms at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--profile', metavar='DIR', help='save a cProfile of every polling cycle under DIR')
+    parser.add_argument('--min-quote-volume', type=float, default=UNIVERSE_MIN_QUOTE_VOLUME,
+                        help='skip USDT pairs that traded less than this in USDT over 24h')
+    parser.add_argument('--top', type=int, metavar='N', help='only trade the N pairs with the most 24h volume')
+    parser.add_argument('--exclude', action='append', metavar='REGEX',
+                        help='skip pairs whose base asset matches REGEX (repeatable; replaces the default '
+                             'stablecoin pattern)')
+    parser.add_argument('--universe-ttl', type=int, default=UNIVERSE_TTL,
+                        help='seconds between refreshes of the symbol metadata')
+    args = parser.parse_args()
+    if args.replay_stream:
+        # Replayed frames must not reach the live candles, indicators or portfolio
+        if args.db and os.path.realpath(args.db) == os.path.realpath('crypto_trading.db'):
+            parser.error('--replay-stream needs a scratch database, not crypto_trading.db')
+        if args.candle_store:
+            parser.error('--replay-stream cannot be combined with --candle-store')
+
+    configure_logging(args.log_level, args.log_json)
+    set_universe(SymbolUniverse(min_quote_volume=args.min_quote_volume, top_n=args.top,
+                                exclude=UNIVERSE_EXCLUDE if args.exclude is None else args.exclude,
+                                ttl=args.universe_ttl))
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    path = args.db or 'crypto_trading.db'
+    if args.replay_stream and not args.db:
+        path = os.path.join(tempfile.mkdtemp(prefix='replay-'), 'replay.db')
+        logger.info('Replaying into scratch database %s', path)
+    conn = open_db(path)
     create_tables(conn)
 
+    if args.verify_indicators:
+        for symbol, interval in conn.execute('SELECT DISTINCT symbol, interval FROM raw_data').fetchall():
+            mismatches = verify_indicators(conn, symbol, interval=interval)
+            if mismatches:
+                logger.warning('Indicator mismatch for %s %s: %s', symbol, interval, mismatches)
+        conn.close()
+        return
+
+    # Fail before fetching anything if a strategy reads bars the base interval cannot build
+    plan_intervals(STRATEGIES, args.base_interval)
+    store = CandleStore(args.candle_store) if args.candle_store else None
+    if args.replay_stream:
+        stream = KlineStream(recorded_symbols(args.replay_stream), args.base_interval,
+                             connect=replay_connect(args.replay_stream), reconnect=False)
+        run_stream(conn, stream, store=store, gap_fill=False)
+        conn.close()
+        return
+    if args.stream:
+        run_stream(conn, KlineStream(fetch_usdt_pairs(), args.base_interval, record=args.record_stream), store=store)
+        conn.close()
+        return
+    pipeline = None
+    if args.workers > 1 and store is None:
+        pipeline = Pipeline(conn, workers=args.workers)
+    profiler = CycleProfiler(args.profile) if args.profile else None
     while True:
-        execute_strategy(conn, "Simple Strategy", simple_strategy)
-        execute_strategy(conn, "EMA Crossover Strategy", ema_crossover_strategy)
-        execute_strategy(conn, "RSI Overbought/Oversold Strategy", rsi_overbought_oversold_strategy)
-        execute_strategy(conn, "Moving Average Crossover Strategy", moving_average_crossover_strategy)
-        execute_strategy(conn, "Stochastic Oscillator Strategy", stochastic_oscillator_strategy)
+        with profiler.cycle() if profiler else nullcontext():
+            if pipeline is not None:
+                pipeline.run_cycle(args.base_interval)
+            else:
+                run_cycle(conn, store=store, base_interval=args.base_interval)
         time.sleep(60)  # Wait for 60 seconds before fetching data again
     
     conn.close()